@@ -1,44 +1,94 @@
+import asyncio
 import json
 import sys
+import threading
 
 import requests
+from requests.adapters import HTTPAdapter
 from time import sleep
+from urllib.parse import quote
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+class XLDRequestError(Exception):
+    pass
 
 
 class XLDMeasClient:
-    def __init__(self, server_ip: str, user: str, group: str, server_port: int = 8080, update_interval: int = 30):
+    def __init__(self, server_ip: str, user: str, group: str, server_port: int = 8080, update_interval: int = 30,
+                 long_poll: bool = True, long_poll_timeout: int = 25, retries: int = 3, backoff: float = 0.5,
+                 pool_size: int = 4, fridge: str = None, heartbeat_interval: float = 10):
         self.user = user
         self.group = group
         self.id = None
         self.server_ip = server_ip
         self.server_port = server_port
-        self.http_ip_port = f'http://{server_ip}:{self.server_port}'
+        self.fridge = fridge
+        # servers with several fridges serve each under /fridge/<name>, without a name the default one
+        self.http_ip_port = f'http://{server_ip}:{self.server_port}' + (f'/fridge/{fridge}' if fridge else '')
         self.listen_delay = 10
         self.running = False
         self.update_interval = update_interval
+        self.long_poll = long_poll
+        self.long_poll_timeout = long_poll_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self._state = None
+        self._state_etag = None
+        # sent from a background thread while the session is open, None or 0 leaves crashes to the point timeout
+        self.heartbeat_interval = heartbeat_interval
+        self._heartbeat = None
+        self._heartbeat_stop = threading.Event()
 
-    @staticmethod
-    def _generic_request(path: str, payload: dict = None):
-        try:
-            if payload is None:
-                response = requests.get(path)
-            else:
-                headers = {'Content-Type': 'application/json'}
-                response = requests.post(path, data=json.dumps(payload), headers=headers)
-            response.raise_for_status()
+        # keep-alive connections are reused for all requests of this client
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
 
-            return response.json()
+    def _generic_request(self, path: str, payload: dict = None, timeout: float = None, idempotent: bool = True):
+        # requests that are not idempotent, like registrations, are only repeated if they never reached the server
+        for attempt in range(self.retries + 1):
+            try:
+                if payload is None:
+                    response = self.session.get(path, timeout=timeout)
+                else:
+                    headers = {'Content-Type': 'application/json'}
+                    response = self.session.post(path, data=json.dumps(payload), headers=headers, timeout=timeout)
+                response.raise_for_status()
 
-        except Exception as ex:
-            print(ex)
-            return
+                return response.json()
+
+            except requests.HTTPError as ex:
+                if ex.response.status_code < 500 or not idempotent:
+                    raise XLDRequestError(f'Request to {path} failed: {ex}') from ex
+                error = ex
+
+            except requests.ConnectTimeout as ex:
+                error = ex
+
+            except (requests.ConnectionError, requests.Timeout) as ex:
+                if not idempotent:
+                    raise XLDRequestError(f'Request to {path} failed, the server may have processed it: {ex}') from ex
+                error = ex
+
+            if attempt < self.retries:
+                print(f'Request to {path} failed ({error}). Retrying.')
+                sleep(self.backoff * 2 ** attempt)
+
+        raise XLDRequestError(f'Request to {path} failed after {self.retries + 1} attempts: {error}') from error
 
     def _make_endpoint(self, *args):
         return self.http_ip_port + '/' + '/'.join(args)
 
     def _register(self):
         payload = {'user': self.user, 'group': self.group}
-        response = self._generic_request(path=self._make_endpoint('meas', 'register'), payload=payload)
+        response = self._generic_request(path=self._make_endpoint('meas', 'register'), payload=payload,
+                                         idempotent=False)
         if 'error' in response.keys():
             print(response['error'])
             sys.exit("Failed to register at server.")
@@ -51,13 +101,32 @@ class XLDMeasClient:
         return response['deregistered']
 
     def listen(self, autostart=True):
+        use_long_poll = self.long_poll
+        signal = None
         while True:
-            sleep(self.update_interval)
-            payload = {'id': self.id}
-            response = self._generic_request(path=self._make_endpoint('meas', 'signal'), payload=payload)
-            print(f'Pinged server. Response: {response}')
+            if use_long_poll:
+                payload = {'id': self.id, 'signal': signal, 'timeout': self.long_poll_timeout}
+                try:
+                    response = self._generic_request(path=self._make_endpoint('meas', 'signal', 'wait'),
+                                                     payload=payload, timeout=self.long_poll_timeout + 10)
+                except XLDRequestError:
+                    print("Long-poll failed. Falling back to polling.")
+                    use_long_poll = False
+                    continue
+
+            else:
+                sleep(self.update_interval)
+                payload = {'id': self.id}
+                try:
+                    response = self._generic_request(path=self._make_endpoint('meas', 'signal'), payload=payload)
+                except XLDRequestError as ex:
+                    print(ex)
+                    continue
+                print(f'Pinged server. Response: {response}')
+
             try:
-                if response['signal'] == 'go':
+                signal = response['signal']
+                if signal == 'go':
                     if autostart:
                         self.started()
                     return True
@@ -75,23 +144,77 @@ class XLDMeasClient:
     def stopped(self):
         self._running_update(running=False)
 
+    def report_progress(self, progress: float):
+        # fraction of the current sweep point, cheap enough to call after every trace
+        payload = {'id': self.id, 'progress': progress}
+        self._generic_request(path=self._make_endpoint('meas', 'progress'), payload=payload)
+
+    def _heartbeat_ids(self):
+        return [self.id]
+
+    def _heartbeat_loop(self):
+        while True:
+            payload = {'ids': self._heartbeat_ids(), 'interval': self.heartbeat_interval}
+            try:
+                self._generic_request(path=self._make_endpoint('meas', 'heartbeat'), payload=payload,
+                                      timeout=self.heartbeat_interval)
+            except XLDRequestError as ex:
+                print(ex)
+
+            if self._heartbeat_stop.wait(self.heartbeat_interval):
+                return
+
+    def _start_heartbeat(self):
+        if self.heartbeat_interval and self._heartbeat is None:
+            self._heartbeat_stop.clear()
+            self._heartbeat = threading.Thread(target=self._heartbeat_loop, name='XLD heartbeat', daemon=True)
+            self._heartbeat.start()
+
+    def _stop_heartbeat(self):
+        if self._heartbeat is not None:
+            self._heartbeat_stop.set()
+            self._heartbeat.join()
+            self._heartbeat = None
+
     def open_session(self):
         self._register()
+        self._start_heartbeat()
         print(f"Registered at {self.server_ip}. API ID: {self.id}")
         print("Waiting for sweep info broadcast.")
         return self._wait_for_sweep_info()
 
     def close_session(self):
+        self._stop_heartbeat()
         if self._deregister():
             print("Deregistered successfully.")
+        self.session.close()
 
     def _wait_for_sweep_info(self):
+        use_long_poll = self.long_poll
         while True:
-            sleep(self.update_interval)
-            response = self._generic_request(path=self._make_endpoint('temperature-sweep', 'info'))
-            print(f'Pinged server. Response: {response}')
+            if use_long_poll:
+                try:
+                    response = self._generic_request(
+                        path=self._make_endpoint('temperature-sweep', 'info', 'wait') + f'?timeout={self.long_poll_timeout}'
+                        f'&group={quote(self.group)}',
+                        timeout=self.long_poll_timeout + 10)
+                except XLDRequestError:
+                    print("Long-poll failed. Falling back to polling.")
+                    use_long_poll = False
+                    continue
+
+            else:
+                sleep(self.update_interval)
+                try:
+                    response = self._generic_request(path=self._make_endpoint('temperature-sweep', 'info'))
+                except XLDRequestError as ex:
+                    print(ex)
+                    continue
+                print(f'Pinged server. Response: {response}')
+
             try:
-                if response['confirmed']:
+                # sweeps from the queue may be meant for another group
+                if response['confirmed'] and response.get('client_group') in (None, self.group):
                     n_sweep = response['sweep_points']
                     timeout = response['client_timeout']
                     return int(n_sweep), float(timeout)
@@ -103,3 +226,291 @@ class XLDMeasClient:
         response = self._generic_request(path= self._make_endpoint('temps', 'mxc'))
 
         return response['mxc_temp']
+
+    def get_state(self):
+        headers = {'If-None-Match': self._state_etag} if self._state_etag else {}
+        try:
+            response = self.session.get(self._make_endpoint('state'), headers=headers)
+            if response.status_code == 304:
+                return self._state
+            response.raise_for_status()
+
+        except Exception as ex:
+            print(ex)
+            return self._state
+
+        self._state = response.json()
+        self._state_etag = response.headers.get('ETag')
+
+        return self._state
+
+
+class XLDMeasClientGroup(XLDMeasClient):
+    # count measurements of one process, e.g. parallel resonator measurements, sharing each request to the server.
+    # started and stopped take a subset of ids for members that finish on their own.
+    def __init__(self, server_ip: str, user: str, group: str, count: int, **kwargs):
+        super().__init__(server_ip, user, group, **kwargs)
+        self.count = count
+        self.ids = []
+
+    def _register(self):
+        payload = {'user': self.user, 'group': self.group, 'count': self.count}
+        response = self._generic_request(path=self._make_endpoint('meas', 'register', 'batch'), payload=payload,
+                                         idempotent=False)
+        if 'error' in response.keys():
+            print(response['error'])
+            sys.exit("Failed to register at server.")
+
+        self.ids = response['ids']
+
+    def _deregister(self):
+        payload = {'ids': self.ids}
+        response = self._generic_request(path=self._make_endpoint('meas', 'deregister', 'batch'), payload=payload)
+        return response['deregistered'] == len(self.ids)
+
+    def listen(self, autostart=True):
+        use_long_poll = self.long_poll
+        signals = None
+        while True:
+            if use_long_poll:
+                payload = {'ids': self.ids, 'signals': signals, 'timeout': self.long_poll_timeout}
+                try:
+                    response = self._generic_request(path=self._make_endpoint('meas', 'signal', 'wait', 'batch'),
+                                                     payload=payload, timeout=self.long_poll_timeout + 10)
+                except XLDRequestError:
+                    print("Long-poll failed. Falling back to polling.")
+                    use_long_poll = False
+                    continue
+
+            else:
+                sleep(self.update_interval)
+                payload = {'ids': self.ids}
+                try:
+                    response = self._generic_request(path=self._make_endpoint('meas', 'signal', 'batch'),
+                                                     payload=payload)
+                except XLDRequestError as ex:
+                    print(ex)
+                    continue
+                print(f'Pinged server. Response: {response}')
+
+            try:
+                signals = response['signals']
+                if all(signals.get(meas_id) == 'go' for meas_id in self.ids):
+                    if autostart:
+                        self.started()
+                    return True
+            except (TypeError, KeyError, AttributeError):
+                print("Error on server side. Wrong response received.")
+
+    def _running_update(self, running, ids: list = None):
+        payload = {'ids': self.ids if ids is None else list(ids), 'running': running}
+        response = self._generic_request(path=self._make_endpoint('meas', 'status', 'set', 'batch'), payload=payload)
+        self.running = bool(response['running'])
+
+    def started(self, ids: list = None):
+        self._running_update(running=True, ids=ids)
+
+    def stopped(self, ids: list = None):
+        self._running_update(running=False, ids=ids)
+
+    def report_progress(self, progress):
+        # one fraction for all members or {id: fraction} for some of them
+        if not isinstance(progress, dict):
+            progress = {meas_id: progress for meas_id in self.ids}
+        self._generic_request(path=self._make_endpoint('meas', 'progress', 'batch'), payload={'progress': progress})
+
+    def _heartbeat_ids(self):
+        return self.ids
+
+    def open_session(self):
+        self._register()
+        self._start_heartbeat()
+        print(f"Registered {len(self.ids)} measurements at {self.server_ip}. API IDs: {', '.join(self.ids)}")
+        print("Waiting for sweep info broadcast.")
+        return self._wait_for_sweep_info()
+
+
+class AsyncXLDMeasClient:
+    # Many clients can share one aiohttp.ClientSession (and its connection pool) by passing it as session.
+    def __init__(self, server_ip: str, user: str, group: str, server_port: int = 8080, update_interval: int = 30,
+                 long_poll: bool = True, long_poll_timeout: int = 25, retries: int = 3, backoff: float = 0.5,
+                 session=None, fridge: str = None, heartbeat_interval: float = 10):
+        if aiohttp is None:
+            raise ImportError("AsyncXLDMeasClient requires aiohttp. Install it with 'pip install xld-client[async]'.")
+
+        self.user = user
+        self.group = group
+        self.id = None
+        self.server_ip = server_ip
+        self.server_port = server_port
+        self.fridge = fridge
+        # servers with several fridges serve each under /fridge/<name>, without a name the default one
+        self.http_ip_port = f'http://{server_ip}:{self.server_port}' + (f'/fridge/{fridge}' if fridge else '')
+        self.running = False
+        self.update_interval = update_interval
+        self.long_poll = long_poll
+        self.long_poll_timeout = long_poll_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.session = session
+        self._own_session = session is None
+        self.heartbeat_interval = heartbeat_interval
+        self._heartbeat = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def close(self):
+        if self._own_session and self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def _generic_request(self, path: str, payload: dict = None, timeout: float = None,
+                               idempotent: bool = True):
+        if self.session is None:
+            self.session = aiohttp.ClientSession()
+
+        client_timeout = aiohttp.ClientTimeout(total=timeout)
+        for attempt in range(self.retries + 1):
+            try:
+                if payload is None:
+                    request = self.session.get(path, timeout=client_timeout)
+                else:
+                    request = self.session.post(path, json=payload, timeout=client_timeout)
+
+                async with request as response:
+                    response.raise_for_status()
+                    return await response.json(content_type=None)
+
+            except aiohttp.ClientResponseError as ex:
+                if ex.status < 500 or not idempotent:
+                    raise XLDRequestError(f'Request to {path} failed: {ex}') from ex
+                error = ex
+
+            except aiohttp.ClientConnectorError as ex:
+                error = ex
+
+            except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+                if not idempotent:
+                    raise XLDRequestError(f'Request to {path} failed, the server may have processed it: {ex!r}') from ex
+                error = ex
+
+            if attempt < self.retries:
+                print(f'Request to {path} failed ({error!r}). Retrying.')
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+
+        raise XLDRequestError(f'Request to {path} failed after {self.retries + 1} attempts: {error!r}') from error
+
+    def _make_endpoint(self, *args):
+        return self.http_ip_port + '/' + '/'.join(args)
+
+    async def _register(self):
+        payload = {'user': self.user, 'group': self.group}
+        response = await self._generic_request(path=self._make_endpoint('meas', 'register'), payload=payload,
+                                               idempotent=False)
+        if 'error' in response.keys():
+            raise XLDRequestError(f"Failed to register at server: {response['error']}")
+
+        self.id = response['id']
+
+    async def _deregister(self):
+        payload = {'id': self.id}
+        response = await self._generic_request(path=self._make_endpoint('meas', 'deregister'), payload=payload)
+        return response['deregistered']
+
+    async def _wait_for(self, long_poll_path: str, poll_path: str, payload: dict, done):
+        use_long_poll = self.long_poll
+        while True:
+            if use_long_poll:
+                try:
+                    response = await self._generic_request(path=long_poll_path, payload=payload(True),
+                                                           timeout=self.long_poll_timeout + 10)
+                except XLDRequestError:
+                    print("Long-poll failed. Falling back to polling.")
+                    use_long_poll = False
+                    continue
+
+            else:
+                await asyncio.sleep(self.update_interval)
+                try:
+                    response = await self._generic_request(path=poll_path, payload=payload(False))
+                except XLDRequestError as ex:
+                    print(ex)
+                    continue
+
+            if isinstance(response, dict) and done(response):
+                return response
+
+    async def listen(self, autostart=True):
+        last = {'signal': None}
+
+        def payload(long_poll):
+            if long_poll:
+                return {'id': self.id, 'signal': last['signal'], 'timeout': self.long_poll_timeout}
+            return {'id': self.id}
+
+        def done(response):
+            last['signal'] = response.get('signal')
+            return last['signal'] == 'go'
+
+        await self._wait_for(self._make_endpoint('meas', 'signal', 'wait'), self._make_endpoint('meas', 'signal'),
+                             payload, done)
+        if autostart:
+            await self.started()
+
+        return True
+
+    async def _running_update(self, running):
+        payload = {'id': self.id, 'running': running}
+        response = await self._generic_request(path=self._make_endpoint('meas', 'status', 'set'), payload=payload)
+        self.running = bool(response['running'])
+
+    async def started(self):
+        await self._running_update(running=True)
+
+    async def stopped(self):
+        await self._running_update(running=False)
+
+    async def report_progress(self, progress: float):
+        payload = {'id': self.id, 'progress': progress}
+        await self._generic_request(path=self._make_endpoint('meas', 'progress'), payload=payload)
+
+    async def _heartbeat_loop(self):
+        while True:
+            payload = {'ids': [self.id], 'interval': self.heartbeat_interval}
+            try:
+                await self._generic_request(path=self._make_endpoint('meas', 'heartbeat'), payload=payload,
+                                            timeout=self.heartbeat_interval)
+            except XLDRequestError as ex:
+                print(ex)
+
+            await asyncio.sleep(self.heartbeat_interval)
+
+    async def open_session(self):
+        await self._register()
+        if self.heartbeat_interval and self._heartbeat is None:
+            self._heartbeat = asyncio.create_task(self._heartbeat_loop())
+        response = await self._wait_for(
+            self._make_endpoint('temperature-sweep', 'info', 'wait') + f'?timeout={self.long_poll_timeout}'
+            f'&group={quote(self.group)}',
+            self._make_endpoint('temperature-sweep', 'info'), lambda long_poll: None,
+            lambda response: response.get('confirmed') and response.get('client_group') in (None, self.group))
+
+        return int(response['sweep_points']), float(response['client_timeout'])
+
+    async def close_session(self):
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+            self._heartbeat = None
+        deregistered = await self._deregister()
+        await self.close()
+
+        return deregistered
+
+    async def get_mxc_temp(self):
+        response = await self._generic_request(path=self._make_endpoint('temps', 'mxc'))
+
+        return response['mxc_temp']
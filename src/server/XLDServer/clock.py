@@ -0,0 +1,85 @@
+from datetime import datetime
+from heapq import heappush, heappop
+from itertools import count
+from math import inf
+from time import monotonic, sleep, time
+
+from notifier import ChangeNotifier
+
+
+class Clock:
+    # Wall clock. Everything that sleeps, waits or timestamps goes through a clock so a sweep can be
+    # replayed against a VirtualClock.
+    def time(self):
+        return time()
+
+    def monotonic(self):
+        return monotonic()
+
+    def now(self):
+        return datetime.now()
+
+    def sleep(self, seconds: float):
+        if seconds > 0:
+            sleep(seconds)
+
+    def wait(self, event, timeout: float = None):
+        return event.wait(timeout)
+
+    def wait_change(self, notifier: ChangeNotifier, version: int, timeout: float):
+        return notifier.wait(version, timeout)
+
+
+class VirtualClock(Clock):
+    # Discrete-event clock. Time only advances inside sleep and the waits, which run the scheduled callbacks
+    # in time order up to the deadline or until the waited-for condition holds. Single threaded: callbacks
+    # are run by the thread that is waiting and must not block themselves.
+    def __init__(self, start: float = None):
+        self._now = time() if start is None else float(start)
+        self._queue = []
+        self._order = count()
+
+    def time(self):
+        return self._now
+
+    def monotonic(self):
+        return self._now
+
+    def now(self):
+        return datetime.fromtimestamp(self._now)
+
+    def call_at(self, when: float, callback, *args):
+        heappush(self._queue, (max(when, self._now), next(self._order), callback, args))
+
+    def call_later(self, delay: float, callback, *args):
+        self.call_at(self._now + delay, callback, *args)
+
+    def call_every(self, interval: float, callback, *args):
+        def tick():
+            self.call_later(interval, tick)
+            callback(*args)
+
+        self.call_later(0, tick)
+
+    def run_until(self, deadline: float, done=None):
+        while done is None or not done():
+            if not self._queue or self._queue[0][0] > deadline:
+                if deadline == inf:
+                    raise RuntimeError("Virtual clock would wait forever: nothing scheduled.")
+                self._now = max(self._now, deadline)
+                return done is None
+
+            when, _, callback, args = heappop(self._queue)
+            self._now = when
+            callback(*args)
+
+        return True
+
+    def sleep(self, seconds: float):
+        self.run_until(self._now + max(seconds, 0))
+
+    def wait(self, event, timeout: float = None):
+        return self.run_until(inf if timeout is None else self._now + timeout, event.is_set)
+
+    def wait_change(self, notifier: ChangeNotifier, version: int, timeout: float):
+        return self.run_until(self._now + timeout, lambda: notifier.version != version)
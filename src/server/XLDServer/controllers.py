@@ -0,0 +1,84 @@
+from threading import Lock
+from time import sleep
+
+import numpy as np
+
+from clock import Clock
+from database_sqlite import ServerDB
+
+BACKENDS = ['blueftc', 'simulated']
+
+
+def make_controller(backend: str = 'blueftc', ip: str = None, **kwargs):
+    if backend == 'blueftc':
+        from blueftc.BlueFTController import BlueFTController
+        return BlueFTController(ip)
+
+    elif backend == 'simulated':
+        return SimulatedController(**kwargs)
+
+    raise ValueError(f"Unknown controller backend '{backend}', expected one of {BACKENDS}.")
+
+
+class SimulatedController:
+    # Stand-in for BlueFTController. Stages relax towards an equilibrium temperature with a first-order lag,
+    # the mixing chamber and still equilibria follow the cooling power P = k * (T^2 - T_base^2) of a dilution unit.
+    def __init__(self, db: ServerDB = None, latency: float = 0.05, tau: float = 300, noise: float = 0.002,
+                 mxc_base: float = 0.01, mxc_k: float = 4e4, still_base: float = 0.8, still_k: float = 2e3,
+                 fourk_temp: float = 3.5, fiftyk_temp: float = 45.0, seed: int = None, clock: Clock = Clock()):
+        db = db if db is not None else ServerDB()
+        self.latency = latency
+        self.tau = tau
+        self.noise = noise
+        self.clock = clock
+        self.lock = Lock()
+
+        self.channels = {db.fiftyk_ch: '50K', db.fourk_ch: '4K', db.still_ch: 'still', db.mxc_ch: 'mxc'}
+        self.heaters = {db.still_switch_ind: 'still switch', db.mxc_switch_ind: 'mxc switch',
+                        db.still_ind: 'still', db.mxc_ind: 'mxc'}
+        self.powers = {i: 0.0 for i in self.heaters}
+
+        # channel: (heater driving it, base temperature, cooling power coefficient in uW/K^2)
+        self.models = {db.mxc_ch: (db.mxc_ind, mxc_base, mxc_k), db.still_ch: (db.still_ind, still_base, still_k),
+                       db.fourk_ch: (None, fourk_temp, None), db.fiftyk_ch: (None, fiftyk_temp, None)}
+        self.temps = {ch: base for ch, (_, base, _) in self.models.items()}
+        self.last_update = clock.time()
+        # one generator per channel, so the noise does not depend on the order of concurrent reads
+        self.rngs = {ch: np.random.default_rng(None if seed is None else [seed, ch]) for ch in self.temps}
+
+    def equilibrium_temp(self, channel: int, power: float = None):
+        heater, base, k = self.models[channel]
+        if heater is None:
+            return base
+
+        power = self.powers[heater] if power is None else power
+        return np.sqrt(base ** 2 + max(power, 0) / k)
+
+    def _advance(self):
+        now = self.clock.time()
+        decay = np.exp(-(now - self.last_update) / self.tau)
+        for ch in self.temps:
+            target = self.equilibrium_temp(ch)
+            self.temps[ch] = target + (self.temps[ch] - target) * decay
+        self.last_update = now
+
+    def get_latest_channel_temp(self, channel: int):
+        sleep(self.latency)
+        with self.lock:
+            self._advance()
+            temp = self.temps[channel] * (1 + self.noise * self.rngs[channel].standard_normal())
+
+        return temp, self.clock.now()
+
+    def get_heater_power(self, heater_nr: int):
+        sleep(self.latency)
+        with self.lock:
+            return self.powers[heater_nr]
+
+    def set_heater_power(self, heater_nr: int, setpower: float):
+        sleep(self.latency)
+        with self.lock:
+            self._advance()
+            self.powers[heater_nr] = float(setpower)
+
+        return True
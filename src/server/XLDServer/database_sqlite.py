@@ -1,23 +1,45 @@
-from dataclasses import dataclass
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+import json
 import secrets
+import threading
 from datetime import datetime
 from multiprocessing import Lock
 import sqlite3 as sq
 import logging
 import os
 
-from measurements import WAIT, GO, RUNNING, CRASHED
+import numpy as np
+
+from downsample import minmax_downsample
+from measurements import WAIT, GO, RUNNING, CRASHED, MISSED_HEARTBEATS
+from metrics import metrics
+from notifier import ChangeNotifier
 from passkey import data_dir, db_filename
 
 xld_logger = logging.getLogger('waitress')
 
+# true for clients whose last heartbeat is more than ? intervals older than ?, false without heartbeats
+HEARTBEATS_MISSED = "IFNULL(last_seen + heartbeat_interval * ? < ?, 0)"
+
+
+def to_epoch(timestamp) -> float:
+    if isinstance(timestamp, datetime):
+        return timestamp.timestamp()
+
+    try:
+        return float(timestamp)
+    except ValueError:
+        return datetime.fromisoformat(timestamp).timestamp()
+
 
 @dataclass
 class ServerDB:
     db_name: str = os.path.join(data_dir, db_filename)
-    meas_lock: Lock = Lock()
     temp_lock: Lock = Lock()
     heater_lock: Lock = Lock()
+    meas_notifier: ChangeNotifier = ChangeNotifier()
+    heater_notifier: ChangeNotifier = ChangeNotifier()
     mxc_ch: int = 6
     still_ch: int = 5
     fourk_ch: int = 2
@@ -26,13 +48,76 @@ class ServerDB:
     still_ind: int = 3
     mxc_switch_ind: int = 2
     still_switch_ind: int = 1
+    busy_timeout: int = 30000
+    cache_size: int = -16000
+    cached_statements: int = 256
+    export_chunk_size: int = 10000
+    # bucket widths in s of the min/max rollups of temp_history, answer zoomed-out plots without the raw rows
+    rollup_widths: tuple = (60, 600, 3600, 21600)
+    _local: threading.local = field(default_factory=threading.local, init=False, repr=False, compare=False)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def _connect(self, check_same_thread: bool = True):
+        con = sq.connect(self.db_name, timeout=self.busy_timeout / 1000, cached_statements=self.cached_statements,
+                         check_same_thread=check_same_thread)
+        con.execute("PRAGMA journal_mode = WAL")
+        con.execute("PRAGMA synchronous = NORMAL")
+        con.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout)}")
+        con.execute(f"PRAGMA cache_size = {int(self.cache_size)}")
+        return con
+
+    def _get_connection(self):
+        # one connection per thread and process, sqlite connections must not cross a fork
+        if getattr(self._local, 'pid', None) != os.getpid():
+            self._local.con = self._connect()
+            self._local.pid = os.getpid()
+
+        return self._local.con
+
+    def close(self):
+        if getattr(self._local, 'pid', None) == os.getpid():
+            self._local.con.close()
+        self._local.__dict__.clear()
 
     def _exec_db_command(self, cmd: str, params: tuple = ()):
-        with sq.connect(self.db_name) as con:
+        con = self._get_connection()
+        with metrics.timer('xld_db_statement_seconds', op=cmd.split(maxsplit=1)[0].upper()), con:
             return con.execute(cmd, params)
 
-    def _info(self, msg):
-        xld_logger.info(f"DATABASE OPERATION: {msg}")
+    @contextmanager
+    def _transaction(self):
+        # take the write lock up front, so a transaction never fails to upgrade from a read lock
+        con = self._get_connection()
+        with metrics.timer('xld_db_statement_seconds', op='TRANSACTION'):
+            con.execute("BEGIN IMMEDIATE")
+            try:
+                yield con
+            except BaseException:
+                con.rollback()
+                raise
+            else:
+                con.commit()
+
+    @contextmanager
+    def _locked(self, lock: Lock, name: str):
+        with metrics.timer('xld_db_lock_wait_seconds', lock=name):
+            lock.acquire()
+        try:
+            yield
+        finally:
+            lock.release()
+
+    def _info(self, msg, aggregate: str = None):
+        # hot-path messages pass an aggregate key and are rate limited by the log pipeline
+        xld_logger.info(f"DATABASE OPERATION: {msg}", extra={'aggregate': aggregate})
 
     def _warning(self, msg):
         xld_logger.warning(f"DATABASE OPERATION: {msg}")
@@ -46,97 +131,243 @@ class ServerDB:
         progress NUMERIC,
         running BOOLEAN,
         signal VARCHAR,
-        crashed BOOLEAN DEFAULT 0)''')
+        crashed BOOLEAN DEFAULT 0,
+        progress_tstamp REAL,
+        point_start REAL,
+        last_seen REAL,
+        heartbeat_interval REAL)''')
+        # clients tables created before progress reporting and heartbeats
+        columns = [row[1] for row in self._exec_db_command("PRAGMA table_info(clients)")]
+        for column in ['progress_tstamp', 'point_start', 'last_seen', 'heartbeat_interval']:
+            if column not in columns:
+                self._exec_db_command(f"ALTER TABLE clients ADD COLUMN {column} REAL")
         self._exec_db_command('''CREATE TABLE if not exists temps
         (channel NUMERIC PRIMARY KEY,
         temp NUMERIC,
         tstamp DATETIME)''')
+        self._exec_db_command('''CREATE TABLE if not exists temp_history
+        (channel INTEGER NOT NULL,
+        tstamp REAL NOT NULL,
+        temp REAL,
+        PRIMARY KEY (channel, tstamp)) WITHOUT ROWID''')
+        backfill = not self._exec_db_command("SELECT name FROM sqlite_master WHERE name = 'temp_rollups'").fetchall()
+        self._exec_db_command('''CREATE TABLE if not exists temp_rollups
+        (channel INTEGER NOT NULL,
+        width INTEGER NOT NULL,
+        bucket REAL NOT NULL,
+        tmin REAL,
+        tmin_t REAL,
+        tmax REAL,
+        tmax_t REAL,
+        PRIMARY KEY (channel, width, bucket)) WITHOUT ROWID''')
+        if backfill:
+            self._backfill_rollups()
         self._exec_db_command('''CREATE TABLE if not exists heaters
         (h_ind NUMERIC PRIMARY KEY,
         power NUMERIC,
-        tstamp DATETIME)''')
+        tstamp DATETIME,
+        dirty BOOLEAN DEFAULT 0)''')
+        # heaters tables created before dirty tracking
+        if 'dirty' not in [row[1] for row in self._exec_db_command("PRAGMA table_info(heaters)")]:
+            self._exec_db_command("ALTER TABLE heaters ADD COLUMN dirty BOOLEAN DEFAULT 0")
+        self._exec_db_command('''CREATE TABLE if not exists metrics
+        (process VARCHAR NOT NULL,
+        name VARCHAR NOT NULL,
+        labels VARCHAR NOT NULL,
+        buckets VARCHAR,
+        total REAL,
+        count INTEGER,
+        PRIMARY KEY (process, name, labels))''')
+        self._exec_db_command('''CREATE TABLE if not exists setpoints
+        (h_ind INTEGER PRIMARY KEY,
+        channel INTEGER,
+        target REAL,
+        kp REAL,
+        ki REAL,
+        kd REAL,
+        max_power REAL,
+        tstamp REAL)''')
+        self._exec_db_command('''CREATE TABLE if not exists sweeps
+        (sweep_id VARCHAR PRIMARY KEY,
+        params VARCHAR,
+        state VARCHAR,
+        n_points INTEGER,
+        completed INTEGER DEFAULT 0,
+        start_time REAL,
+        tstamp REAL)''')
+        self._exec_db_command('''CREATE TABLE if not exists sweep_points
+        (sweep_id VARCHAR NOT NULL,
+        point INTEGER NOT NULL,
+        mode VARCHAR,
+        target REAL,
+        power REAL,
+        temp REAL,
+        go_time REAL,
+        done_time REAL,
+        PRIMARY KEY (sweep_id, point))''')
+        # sweeps waiting to be started by the scheduler, highest priority first and in order of submission
+        self._exec_db_command('''CREATE TABLE if not exists sweep_queue
+        (job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name VARCHAR,
+        params VARCHAR,
+        client_group VARCHAR,
+        priority INTEGER DEFAULT 0,
+        min_clients INTEGER DEFAULT 0,
+        est_duration REAL,
+        state VARCHAR,
+        sweep_id VARCHAR,
+        submit_time REAL,
+        start_time REAL)''')
+        self._exec_db_command('''CREATE TABLE if not exists power_map
+        (power REAL PRIMARY KEY,
+        temp REAL,
+        tstamp REAL)''')
 
         self._info("Created database tables.")
 
-    def _get_all_ids(self):
-        cursor = self._exec_db_command("SELECT id FROM clients")
-        ids = [row[0] for row in cursor]
-
-        return ids
+    @staticmethod
+    def _meas_dict(row):
+        return {'id': row[0], 'user': row[1], 'group': row[2], 'timestamp': row[3], 'progress': row[4],
+                'running': row[5], 'signal': row[6], 'crashed': row[7], 'progress_time': row[8],
+                'point_start': row[9], 'last_seen': row[10], 'heartbeat_interval': row[11]}
 
     def register_measurement(self, user: str, group: str):
-        with self.meas_lock:
-            ids = self._get_all_ids()
-            unique = False
-            while not unique:
-                token = secrets.token_urlsafe(16)
-                if token not in ids:
-                    unique = True
-
-            self._exec_db_command("INSERT INTO clients (id, user_name, w_group, start_time, progress, running, signal)"
-                                  "VALUES (?, ?, ?, ?, ?, ?, ?)", (token, user, group, datetime.now(), -1, False, WAIT))
-
-            self._info(f"Measurement registered by {user} ({group}) with ID {token}.")
-        return token
+        return self.register_measurements(user, group, count=1)[0]
+
+    def register_measurements(self, user: str, group: str, count: int):
+        # all measurements of one process in a single transaction
+        while True:
+            tokens = [secrets.token_urlsafe(16) for _ in range(count)]
+            timestamp = datetime.now()
+            try:
+                with self._transaction() as con:
+                    con.executemany("INSERT INTO clients (id, user_name, w_group, start_time, progress, running, "
+                                    "signal) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                    [(token, user, group, timestamp, -1, False, WAIT) for token in tokens])
+                break
+            except sq.IntegrityError:
+                continue
+
+        self._info(f"{count} measurement(s) registered by {user} ({group}) with ID(s) {', '.join(tokens)}.")
+        self.meas_notifier.notify()
+        return tokens
 
     def deregister_measurement(self, meas_id: str):
-        with self.meas_lock:
-            if meas_id in self._get_all_ids():
-                self._exec_db_command("DELETE FROM clients WHERE id = ?;", (meas_id,))
+        return self.deregister_measurements([meas_id]) > 0
 
-            self._info(f"Measurement with ID {meas_id} deregistered.")
+    def deregister_measurements(self, meas_ids: list):
+        deleted = self._exec_db_command(f"DELETE FROM clients WHERE id IN ({', '.join('?' * len(meas_ids))})",
+                                        tuple(meas_ids)).rowcount
+        if deleted:
+            self._info(f"{deleted} measurement(s) with ID(s) {', '.join(meas_ids)} deregistered.")
+            self.meas_notifier.notify()
+
+        return deleted
 
     def get_html_meas_dict(self):
-        meas = []
-        with self.meas_lock:
-            cursor = self._exec_db_command("SELECT * FROM clients")
-            for row in cursor:
-                meas.append({'id': row[0], 'user': row[1], 'group': row[2], 'timestamp': row[3], 'progress': row[4],
-                             'running': row[5], 'signal': row[6], 'crashed': row[7]})
+        cursor = self._exec_db_command("SELECT * FROM clients")
 
-            return meas
+        return [self._meas_dict(row) for row in cursor]
 
     def get_single_meas_dict(self, meas_id):
-        with self.meas_lock:
-            cursor = self._exec_db_command("SELECT * FROM clients where id = ?", (meas_id, ))
-            for row in cursor:
-                return {'id': row[0], 'user': row[1], 'group': row[2], 'timestamp': row[3], 'progress': row[4],
-                        'running': row[5], 'signal': row[6], 'crashed': row[7]}
-
-    def set_meas_status(self, meas_id: str, status: bool):
-        with self.meas_lock:
-            if meas_id in self._get_all_ids():
-                self._exec_db_command("UPDATE clients SET running = ? WHERE id = ?", (status, meas_id))
-                self._info(f"Set measurement {meas_id} to running = {status}.")
-
-                if status:
-                    self._exec_db_command("UPDATE clients SET signal = ? WHERE id = ?", (RUNNING, meas_id))
-                    self._info(f"Set measurement {meas_id} to signal = {RUNNING}.")
-
-                else:
-                    self._exec_db_command("UPDATE clients SET signal = ? WHERE id = ?", (WAIT, meas_id))
-                    self._info(f"Set measurement {meas_id} to signal = {WAIT}.")
-
-                return status
+        row = self._exec_db_command("SELECT * FROM clients where id = ?", (meas_id, )).fetchone()
+        if row is not None:
+            return self._meas_dict(row)
+
+    def set_meas_status(self, meas_id: str, status: bool, skip_crashed: bool = False, timestamp: datetime = None):
+        if self.set_meas_statuses([meas_id], status=status, skip_crashed=skip_crashed, timestamp=timestamp) > 0:
+            return status
+
+    def set_meas_statuses(self, meas_ids: list, status: bool, skip_crashed: bool = False,
+                          timestamp: datetime = None):
+        # a started measurement begins a new point at progress 0, a stopped one is done with it
+        signal = RUNNING if status else WAIT
+        now = to_epoch(datetime.now() if timestamp is None else timestamp)
+        cmd = (f"UPDATE clients SET running = ?, signal = ?, progress = ?, progress_tstamp = ?, crashed = 0, "
+               f"point_start = {'?' if status else 'point_start'} WHERE id IN ({', '.join('?' * len(meas_ids))})")
+        params = (status, signal, 0 if status else 1, now) + ((now,) if status else ()) + tuple(meas_ids)
+        if skip_crashed:
+            # clients crashed for missed heartbeats are back once they report again, timed out ones stay out
+            cmd += f" AND (NOT crashed OR {HEARTBEATS_MISSED})"
+            params += (MISSED_HEARTBEATS, now)
+
+        updated = self._exec_db_command(cmd, params).rowcount
+        if updated:
+            # not sampled, operators follow which client stalled a point in these
+            self._info(f"Set {updated} measurement(s) {', '.join(meas_ids)} to running = {status}, signal = {signal}.")
+            self.meas_notifier.notify()
+
+        return updated
 
     def set_meas_as_crashed(self, meas_id):
-        with self.meas_lock:
-            if meas_id in self._get_all_ids():
-                self._exec_db_command("UPDATE clients SET crashed = ? WHERE id = ?", (True, meas_id))
-                self._warning(f"Marked measurement {meas_id} as crashed.")
-
-    def write_temp(self, channel: int, val: float, timestamp: datetime = datetime.now()):
-        with self.temp_lock:
-            self._exec_db_command("INSERT INTO temps (channel, temp, tstamp)"
-                                  "VALUES (?, ?, ?)"
-                                  "ON CONFLICT(channel)"
-                                  "DO UPDATE SET temp = ?, tstamp = ?",
-                                  (channel, val, timestamp, val, timestamp))
-
-            self._info(f'Written temp = {val} to channel {channel}.')
+        if self._exec_db_command("UPDATE clients SET crashed = ? WHERE id = ?", (True, meas_id)).rowcount > 0:
+            self._warning(f"Marked measurement {meas_id} as crashed.")
+            self.meas_notifier.notify()
+
+    def write_heartbeats(self, meas_ids: list, interval: float, timestamp: datetime = None):
+        now = to_epoch(datetime.now() if timestamp is None else timestamp)
+        ids = ', '.join('?' * len(meas_ids))
+        # a late heartbeat means the client was only unreachable, undo a crash it caused
+        revived = [row[0] for row in self._exec_db_command(
+            f"SELECT id FROM clients WHERE crashed AND {HEARTBEATS_MISSED} AND id IN ({ids})",
+            (MISSED_HEARTBEATS, now, *meas_ids))]
+        updated = self._exec_db_command(f"UPDATE clients SET last_seen = ?, heartbeat_interval = ?, "
+                                        f"crashed = crashed AND NOT {HEARTBEATS_MISSED} WHERE id IN ({ids})",
+                                        (now, interval, MISSED_HEARTBEATS, now, *meas_ids)).rowcount
+        self._info(f"Heartbeat of {updated} measurement(s).", aggregate='heartbeats')
+        if revived:
+            self._warning(f"Measurement(s) {', '.join(revived)} sent heartbeats again and are no longer crashed.")
+            self.meas_notifier.notify()
+
+        return updated
+
+    def mark_silent_meas_as_crashed(self, missed: int = MISSED_HEARTBEATS, group: str = None,
+                                    timestamp: datetime = None):
+        # measurements in a sweep point that sent heartbeats before and then missed several in a row,
+        # clients without heartbeats are left to the point timeout
+        cmd = (f"FROM clients WHERE NOT crashed AND signal IN (?, ?) AND {HEARTBEATS_MISSED} "
+               f"AND (? IS NULL OR w_group = ?)")
+        params = (RUNNING, GO, missed, to_epoch(datetime.now() if timestamp is None else timestamp), group, group)
+        # checked every few seconds while a point runs, only take the write lock if there is something to mark
+        silent = [row[0] for row in self._exec_db_command(f"SELECT id {cmd}", params)]
+        if silent:
+            self._exec_db_command(f"UPDATE clients SET crashed = 1 WHERE id IN (SELECT id {cmd})", params)
+            self._warning(f"Marked measurement(s) {', '.join(silent)} as crashed after {missed} missed heartbeats.")
+            self.meas_notifier.notify()
+
+        return silent
+
+    def write_temp(self, channel: int, val: float, timestamp: datetime = None):
+        self.write_temps([(channel, val, timestamp)])
+
+    def write_temps(self, readings: list):
+        readings = [(ch, val, datetime.now() if ts is None else ts) for ch, val, ts in readings]
+        with self._locked(self.temp_lock, 'temp'):
+            with self._transaction() as con:
+                con.executemany("INSERT INTO temps (channel, temp, tstamp)"
+                                "VALUES (?, ?, ?)"
+                                "ON CONFLICT(channel)"
+                                "DO UPDATE SET temp = excluded.temp, tstamp = excluded.tstamp",
+                                readings)
+                history = [(ch, to_epoch(ts), val) for ch, val, ts in readings]
+                con.executemany("INSERT OR IGNORE INTO temp_history (channel, tstamp, temp)"
+                                "VALUES (?, ?, ?)",
+                                history)
+                con.executemany("INSERT INTO temp_rollups (channel, width, bucket, tmin, tmin_t, tmax, tmax_t)"
+                                "VALUES (?, ?, ?, ?, ?, ?, ?)"
+                                "ON CONFLICT(channel, width, bucket) DO UPDATE SET "
+                                "tmin_t = CASE WHEN excluded.tmin < tmin THEN excluded.tmin_t ELSE tmin_t END, "
+                                "tmin = min(tmin, excluded.tmin), "
+                                "tmax_t = CASE WHEN excluded.tmax > tmax THEN excluded.tmax_t ELSE tmax_t END, "
+                                "tmax = max(tmax, excluded.tmax)",
+                                [(ch, w, ts // w * w, val, ts, val, ts) for ch, ts, val in history
+                                 if val is not None for w in self.rollup_widths])
+
+        self._info(f'Written {len(readings)} temperatures to channels {[r[0] for r in readings]}.',
+                   aggregate='temperature writes')
 
     def read_temp(self, channel: int):
-        with self.temp_lock:
+        with self._locked(self.temp_lock, 'temp'):
             cursor = self._exec_db_command(
                 "SELECT temp from temps WHERE channel = ?", (channel,))
             ts = [row[0] for row in cursor]
@@ -146,18 +377,78 @@ class ServerDB:
             else:
                 return 0
 
-    def write_heater(self, index: int, val: float, timestamp: datetime = datetime.now()):
-        with self.heater_lock:
-            self._exec_db_command("INSERT INTO heaters (h_ind, power, tstamp)"
-                                  "VALUES (?, ?, ?)"
+    def read_temp_history(self, channel: int, start, end):
+        cursor = self._exec_db_command("SELECT tstamp, temp FROM temp_history "
+                                       "WHERE channel = ? AND tstamp BETWEEN ? AND ? ORDER BY tstamp",
+                                       (channel, to_epoch(start), to_epoch(end)))
+        return cursor.fetchall()
+
+    def _backfill_rollups(self):
+        # histories recorded before the rollups existed, the bare tstamp column comes from the min or max row
+        with self._transaction() as con:
+            for w in self.rollup_widths:
+                con.execute("INSERT INTO temp_rollups (channel, width, bucket, tmin, tmin_t) "
+                            "SELECT channel, ?, CAST(tstamp / ? AS INTEGER) * ?, min(temp), tstamp FROM temp_history "
+                            "WHERE temp IS NOT NULL GROUP BY channel, CAST(tstamp / ? AS INTEGER)", (w, w, w, w))
+                con.execute("INSERT INTO temp_rollups (channel, width, bucket, tmax, tmax_t) "
+                            "SELECT channel, ?, CAST(tstamp / ? AS INTEGER) * ?, max(temp), tstamp FROM temp_history "
+                            "WHERE temp IS NOT NULL GROUP BY channel, CAST(tstamp / ? AS INTEGER) "
+                            "ON CONFLICT(channel, width, bucket) DO UPDATE SET tmax = excluded.tmax, "
+                            "tmax_t = excluded.tmax_t", (w, w, w, w))
+
+        self._info("Computed temperature rollups of the existing history.")
+
+    def read_temp_history_downsampled(self, channel: int, start, end, max_points: int):
+        # raw rows for short windows, otherwise the finest rollup with at most 2 * max_points buckets in the window,
+        # then min/max bucketing down to max_points
+        start, end = to_epoch(start), to_epoch(end)
+        if (end - start) / self.rollup_widths[0] <= max_points:
+            width = 0
+            rows = self.read_temp_history(channel=channel, start=start, end=end)
+            tstamps, temps = np.array(rows, dtype=float).reshape(-1, 2).T
+        else:
+            width = next((w for w in self.rollup_widths if (end - start) / w <= 2 * max_points),
+                         self.rollup_widths[-1])
+            rows = self._exec_db_command("SELECT tmin_t, tmin, tmax_t, tmax FROM temp_rollups "
+                                         "WHERE channel = ? AND width = ? AND bucket BETWEEN ? AND ?",
+                                         (channel, width, start // width * width, end)).fetchall()
+            rows = np.array(rows, dtype=float).reshape(-1, 2)
+            rows = rows[(rows[:, 0] >= start) & (rows[:, 0] <= end)]
+            tstamps, temps = np.unique(rows, axis=0).T
+
+        tstamps, temps = minmax_downsample(tstamps, temps, start, end, max_points)
+
+        return width, tstamps, temps
+
+    def write_heater(self, index: int, val: float, timestamp: datetime = None, dirty: bool = True):
+        # dirty heaters are pushed to the controller right away, the controller process records actual powers clean
+        timestamp = datetime.now() if timestamp is None else timestamp
+        with self._locked(self.heater_lock, 'heater'):
+            self._exec_db_command("INSERT INTO heaters (h_ind, power, tstamp, dirty)"
+                                  "VALUES (?, ?, ?, ?)"
                                   "ON CONFLICT(h_ind)"
-                                  "DO UPDATE SET power = ?, tstamp = ?",
-                                  (index, val, timestamp, val, timestamp))
+                                  "DO UPDATE SET power = ?, tstamp = ?, dirty = ?",
+                                  (index, val, timestamp, dirty, val, timestamp, dirty))
+
+        if dirty:
+            self.heater_notifier.notify()
+        self._info(f'Written power = {val} to heater {index}.', aggregate='heater writes')
+
+    def pop_dirty_heaters(self):
+        # cheap read first, the write transaction is only needed when there is something to push
+        if self._exec_db_command("SELECT 1 FROM heaters WHERE dirty LIMIT 1").fetchone() is None:
+            return []
 
-            self._info(f'Written power = {val} to heater {index}.')
+        with self._locked(self.heater_lock, 'heater'):
+            with self._transaction() as con:
+                rows = con.execute("SELECT h_ind, power FROM heaters WHERE dirty").fetchall()
+                if rows:
+                    con.execute("UPDATE heaters SET dirty = 0 WHERE dirty")
+
+        return rows
 
     def read_heater(self, index: int):
-        with self.heater_lock:
+        with self._locked(self.heater_lock, 'heater'):
             cursor = self._exec_db_command(
                 "SELECT power from heaters WHERE h_ind = ?", (index,))
             ts = [row[0] for row in cursor]
@@ -167,18 +458,203 @@ class ServerDB:
             else:
                 return 0
 
+    def write_setpoint(self, index: int, channel: int, target: float, kp: float, ki: float, kd: float,
+                       max_power: float, timestamp: datetime = None):
+        timestamp = to_epoch(datetime.now() if timestamp is None else timestamp)
+        self._exec_db_command("INSERT OR REPLACE INTO setpoints (h_ind, channel, target, kp, ki, kd, max_power, tstamp)"
+                              "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                              (index, channel, target, kp, ki, kd, max_power, timestamp))
+        self._info(f'Set heater {index} to hold channel {channel} at {target} K.')
+
+    def read_setpoint(self, index: int):
+        row = self._exec_db_command("SELECT channel, target, kp, ki, kd, max_power, tstamp FROM setpoints "
+                                    "WHERE h_ind = ?", (index,)).fetchone()
+        if row is not None:
+            return dict(zip(['channel', 'target', 'kp', 'ki', 'kd', 'max_power', 'tstamp'], row))
+
+    def clear_setpoint(self, index: int):
+        if self._exec_db_command("DELETE FROM setpoints WHERE h_ind = ?", (index,)).rowcount > 0:
+            self._info(f'Cleared setpoint of heater {index}.')
+
+    def write_power_map(self, power: float, temp: float, timestamp: datetime = None):
+        # one steady-state point per 0.01 uW, newer measurements replace older ones
+        timestamp = to_epoch(datetime.now() if timestamp is None else timestamp)
+        self._exec_db_command("INSERT OR REPLACE INTO power_map (power, temp, tstamp) VALUES (?, ?, ?)",
+                              (round(power, 2), temp, timestamp))
+
+    def read_power_map(self):
+        return self._exec_db_command("SELECT power, temp FROM power_map ORDER BY power").fetchall()
+
+    def write_sweep(self, sweep_id: str, params: dict, n_points: int, timestamp: datetime = None):
+        # params as generated by TemperatureSweepManager, a resumed sweep keeps its progress
+        timestamp = to_epoch(datetime.now() if timestamp is None else timestamp)
+        self._exec_db_command("INSERT INTO sweeps (sweep_id, params, state, n_points, start_time, tstamp)"
+                              "VALUES (?, ?, 'running', ?, ?, ?)"
+                              "ON CONFLICT(sweep_id)"
+                              "DO UPDATE SET state = 'running', tstamp = excluded.tstamp",
+                              (sweep_id, None if params is None else json.dumps(params), n_points, timestamp,
+                               timestamp))
+
+    def set_sweep_state(self, sweep_id: str, state: str, timestamp: datetime = None):
+        timestamp = to_epoch(datetime.now() if timestamp is None else timestamp)
+        self._exec_db_command("UPDATE sweeps SET state = ?, tstamp = ? WHERE sweep_id = ?",
+                              (state, timestamp, sweep_id))
+        self._info(f"Sweep {sweep_id} {state}.")
+
+    def read_unfinished_sweeps(self):
+        # sweeps whose process died without finishing or aborting, latest first
+        cursor = self._exec_db_command("SELECT sweep_id, params, completed, n_points FROM sweeps "
+                                       "WHERE state = 'running' ORDER BY start_time DESC")
+        return [(sweep_id, None if params is None else json.loads(params), completed, n_points)
+                for sweep_id, params, completed, n_points in cursor]
+
+    def write_sweep_point(self, sweep_id: str, point: int, mode: str, target: float, power: float, temp: float,
+                          go_time: datetime):
+        # target is the heater power in uW for direct-power sweeps and the setpoint in K for PID sweeps
+        self._exec_db_command("INSERT OR REPLACE INTO sweep_points (sweep_id, point, mode, target, power, temp, "
+                              "go_time) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                              (sweep_id, point, mode, target, power, temp, to_epoch(go_time)))
+
+    def finish_sweep_point(self, sweep_id: str, point: int, done_time: datetime):
+        # together with the progress, a resumed sweep continues after the last point finished here
+        with self._transaction() as con:
+            con.execute("UPDATE sweep_points SET done_time = ? WHERE sweep_id = ? AND point = ?",
+                        (to_epoch(done_time), sweep_id, point))
+            con.execute("UPDATE sweeps SET completed = ?, tstamp = ? WHERE sweep_id = ?",
+                        (point + 1, to_epoch(done_time), sweep_id))
+
+    def sweep_point_started(self, sweep_id: str, point: int):
+        # GO was sent for the point, clients may have measured it already
+        return self._exec_db_command("SELECT go_time FROM sweep_points WHERE sweep_id = ? AND point = ? "
+                                     "AND done_time IS NULL", (sweep_id, point)).fetchone() is not None
+
+    def mean_point_duration(self):
+        # measurement time of finished sweep points, without thermalization
+        return self._exec_db_command("SELECT AVG(done_time - go_time) FROM sweep_points "
+                                     "WHERE done_time IS NOT NULL").fetchone()[0]
+
+    def enqueue_sweep(self, params: dict, name: str = None, client_group: str = None, priority: int = 0,
+                      min_clients: int = 0, est_duration: float = None):
+        job_id = self._exec_db_command("INSERT INTO sweep_queue (name, params, client_group, priority, min_clients, "
+                                       "est_duration, state, submit_time) VALUES (?, ?, ?, ?, ?, ?, 'queued', ?)",
+                                       (name, json.dumps(params), client_group, priority, min_clients, est_duration,
+                                        datetime.now().timestamp())).lastrowid
+        self._info(f"Queued sweep job {job_id} ({name}) with priority {priority}.")
+
+        return job_id
+
+    def read_sweep_queue(self, include_done: bool = False):
+        # running jobs with the state of their sweep, then the queued ones in the order they will start
+        cursor = self._exec_db_command("SELECT q.job_id, q.name, q.params, q.client_group, q.priority, q.min_clients, "
+                                       "q.est_duration, q.state, q.sweep_id, q.submit_time, q.start_time, s.state, "
+                                       "s.completed, s.n_points FROM sweep_queue q "
+                                       "LEFT JOIN sweeps s ON q.sweep_id = s.sweep_id "
+                                       "WHERE q.state = 'queued' OR (? AND q.state != 'queued') "
+                                       "OR (q.state = 'started' AND s.state = 'running') "
+                                       "ORDER BY q.state = 'queued', q.priority DESC, q.job_id",
+                                       (include_done,))
+        keys = ['job_id', 'name', 'params', 'client_group', 'priority', 'min_clients', 'est_duration', 'state',
+                'sweep_id', 'submit_time', 'start_time', 'sweep_state', 'completed', 'n_points']
+        jobs = [dict(zip(keys, row)) for row in cursor]
+        for job in jobs:
+            job['params'] = json.loads(job['params'])
+
+        return jobs
+
+    def set_sweep_job_started(self, job_id: int, sweep_id: str):
+        self._exec_db_command("UPDATE sweep_queue SET state = 'started', sweep_id = ?, start_time = ? WHERE job_id = ?",
+                              (sweep_id, datetime.now().timestamp(), job_id))
+        self._info(f"Sweep job {job_id} started as sweep {sweep_id}.")
+
+    def cancel_sweep_job(self, job_id: int):
+        if self._exec_db_command("UPDATE sweep_queue SET state = 'cancelled' WHERE job_id = ? AND state = 'queued'",
+                                 (job_id,)).rowcount > 0:
+            self._info(f"Sweep job {job_id} cancelled.")
+            return True
+
+        return False
+
+    def _export(self, query: str, params: tuple = ()):
+        # own connection and read transaction, so the row count and all chunks come from the same snapshot.
+        # Also returns its close, a generator closed before the first chunk skips its finally.
+        con = self._connect(check_same_thread=False)
+        con.execute("BEGIN")
+        count = con.execute(f"SELECT COUNT(*) FROM ({query})", params).fetchone()[0]
+        cursor = con.execute(query, params)
+        columns = [d[0] for d in cursor.description]
+
+        def chunks():
+            try:
+                while True:
+                    rows = cursor.fetchmany(self.export_chunk_size)
+                    if not rows:
+                        return
+                    yield rows
+            finally:
+                con.close()
+
+        return columns, count, chunks(), con.close
+
+    def export_temp_history(self, start, end, channel: int = None):
+        query = "SELECT channel, tstamp, temp FROM temp_history WHERE tstamp BETWEEN ? AND ?"
+        params = (to_epoch(start), to_epoch(end))
+        if channel is not None:
+            query += " AND channel = ?"
+            params += (channel,)
+
+        return self._export(query + " ORDER BY channel, tstamp", params)
+
+    def export_sweep_points(self, sweep_id: str = None):
+        if sweep_id is None:
+            return self._export("SELECT * FROM sweep_points ORDER BY sweep_id, point")
+
+        return self._export("SELECT * FROM sweep_points WHERE sweep_id = ? ORDER BY point", (sweep_id,))
+
+    def write_meas_progress(self, progress: dict):
+        # {id: (progress, epoch)}, never older than what is stored or from before the current point
+        with self._transaction() as con:
+            con.executemany("UPDATE clients SET progress = ?, progress_tstamp = ? WHERE id = ? "
+                            "AND ? >= COALESCE(progress_tstamp, 0) AND ? >= COALESCE(point_start, 0)",
+                            [(p, ts, meas_id, ts, ts) for meas_id, (p, ts) in progress.items()])
+
+        self._info(f"Written progress of {len(progress)} measurement(s).", aggregate='progress writes')
+
     def get_meas_signal(self, meas_id):
-        with self.meas_lock:
-            if meas_id in self._get_all_ids():
-                cursor = self._exec_db_command("SELECT signal from clients WHERE id = ?", (meas_id,))
-                return [row[0] for row in cursor][0]
-
-    def get_all_meas_signals(self):
-        with self.meas_lock:
-            cursor = self._exec_db_command("SELECT signal, crashed from clients WHERE 1")
-            return [(row[0], row[1]) for row in cursor]
-
-    def set_all_meas_to_go(self):
-        with self.meas_lock:
-            self._exec_db_command("UPDATE clients SET signal = ? WHERE 1", (GO,))
-            self._info("Set all measurements to signal = GO.")
+        return self.get_meas_signals([meas_id]).get(meas_id)
+
+    def get_meas_signals(self, meas_ids: list):
+        # unknown ids are left out
+        cursor = self._exec_db_command(f"SELECT id, signal from clients WHERE id IN ({', '.join('?' * len(meas_ids))})",
+                                       tuple(meas_ids))
+        return dict(cursor.fetchall())
+
+    def get_all_meas_signals(self, group: str = None):
+        # group limits it to the clients of one group, as for sweeps from the queue
+        cursor = self._exec_db_command("SELECT signal, crashed from clients WHERE ? IS NULL OR w_group = ?",
+                                       (group, group))
+        return [(row[0], row[1]) for row in cursor]
+
+    def set_all_meas_to_go(self, group: str = None):
+        self._exec_db_command("UPDATE clients SET signal = ? WHERE ? IS NULL OR w_group = ?", (GO, group, group))
+        self._info("Set all measurements to signal = GO." if group is None else
+                   f"Set all measurements of group {group} to signal = GO.")
+        self.meas_notifier.notify()
+
+    def count_meas(self, group: str = None):
+        return self._exec_db_command("SELECT COUNT(*) FROM clients WHERE ? IS NULL OR w_group = ?",
+                                     (group, group)).fetchone()[0]
+
+    def write_metrics(self, process: str, rows: list):
+        # cumulative histograms of one process replace its previous flush
+        with self._transaction() as con:
+            con.execute("DELETE FROM metrics WHERE process = ?", (process,))
+            con.executemany("INSERT INTO metrics (process, name, labels, buckets, total, count)"
+                            "VALUES (?, ?, ?, ?, ?, ?)",
+                            [(process, *row) for row in rows])
+
+    def read_metrics(self):
+        cursor = self._exec_db_command("SELECT name, labels, buckets, total, count FROM metrics")
+        return cursor.fetchall()
+
+    def clear_metrics(self):
+        self._exec_db_command("DELETE FROM metrics")
@@ -0,0 +1,19 @@
+import numpy as np
+
+
+def minmax_downsample(tstamps, temps, start: float, end: float, max_points: int):
+    # Splits [start, end] into max_points // 2 equal buckets and keeps the coldest and the warmest reading of each,
+    # so spikes survive any zoom level. Returns both arrays in time order.
+    tstamps = np.asarray(tstamps, dtype=float)
+    temps = np.asarray(temps, dtype=float)
+    n_buckets = max(max_points // 2, 1)
+    if len(tstamps) <= max_points or end <= start:
+        return tstamps, temps
+
+    buckets = np.clip(((tstamps - start) / (end - start) * n_buckets).astype(int), 0, n_buckets - 1)
+    order = np.lexsort((temps, buckets))
+    first = np.flatnonzero(np.r_[True, buckets[order][1:] != buckets[order][:-1]])
+    last = np.r_[first[1:] - 1, len(order) - 1]
+    keep = np.unique(np.concatenate((order[first], order[last])))
+
+    return tstamps[keep], temps[keep]
@@ -1,10 +1,117 @@
 import logging
+import os
+from logging.handlers import QueueHandler, QueueListener
+from multiprocessing import Queue
+from threading import Event, Lock, Thread
+from time import monotonic
 
 
-
-log_formatter = logging.Formatter("%(asctime)s [%(threadName)-12.12s] [%(levelname)-5.5s]  %(message)s")
+log_formatter = logging.Formatter("%(asctime)s [%(processName)-16.16s] [%(threadName)-12.12s] [%(levelname)-5.5s]  "
+                                  "%(message)s")
 xld_logger = logging.getLogger("XLD Logger")
 
+AGGREGATE_INTERVAL = 60
+
+
+class AggregateFilter(logging.Filter):
+    # Records logged with extra={'aggregate': key} pass at most once per interval and key,
+    # the next one that passes or expired() reports how many were dropped in between.
+    def __init__(self, interval: float = AGGREGATE_INTERVAL):
+        super().__init__()
+        self.interval = interval
+        self._reset()
+        # counts are per process, a forked one starts without its parent's windows and with a free lock
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self.lock = Lock()
+        self.windows = {}
+
+    def filter(self, record):
+        key = getattr(record, 'aggregate', None)
+        if key is None:
+            return True
+
+        now = monotonic()
+        with self.lock:
+            window_start, dropped = self.windows.get(key, (None, 0))
+            if window_start is not None and now - window_start < self.interval:
+                self.windows[key] = (window_start, dropped + 1)
+                return False
+
+            self.windows[key] = (now, 0)
+
+        if dropped:
+            record.msg = f"{record.getMessage()} ({dropped} more {key} in the last {now - window_start:.0f} s)"
+            record.args = ()
+
+        return True
+
+    def expired(self):
+        # windows over with records dropped and no later record to report them, removed once returned
+        now = monotonic()
+        with self.lock:
+            if not self.windows:
+                return []
+            done = [(key, dropped, now - window_start) for key, (window_start, dropped) in self.windows.items()
+                    if dropped and now - window_start >= self.interval]
+            for key, _, _ in done:
+                del self.windows[key]
+
+        return done
+
+
+class AggregateQueueHandler(QueueHandler):
+    # Drops rate limited records in the logging process, before they are formatted and pickled onto the queue.
+    # Forked processes report their expired windows with their next record, the server process on a timer.
+    def __init__(self, queue, interval: float = AGGREGATE_INTERVAL):
+        super().__init__(queue)
+        self.aggregate = AggregateFilter(interval)
+        self.addFilter(self.aggregate)
+
+    def handle(self, record):
+        self.report_expired()
+        return super().handle(record)
+
+    def report_expired(self):
+        for key, dropped, elapsed in self.aggregate.expired():
+            super().handle(logging.makeLogRecord({'name': 'waitress', 'levelno': logging.INFO, 'levelname': 'INFO',
+                                                  'msg': f"{dropped} more {key} in the last {elapsed:.0f} s."}))
+
+
+class AggregateListener(QueueListener):
+    # Reports the dropped counts of the server process on a timer, so a burst of hot-path messages is accounted
+    # for even if none follows.
+    def __init__(self, queue, *handlers, queue_handler: AggregateQueueHandler, respect_handler_level=False):
+        super().__init__(queue, *handlers, respect_handler_level=respect_handler_level)
+        self.queue_handler = queue_handler
+        self._stop_reports = Event()
+        self._reporter = None
+
+    def start(self):
+        super().start()
+        self._reporter = Thread(target=self._report, name='Log Aggregates', daemon=True)
+        self._reporter.start()
+
+    def stop(self):
+        self._stop_reports.set()
+        self._reporter.join()
+        super().stop()
+
+    def _report(self):
+        while not self._stop_reports.wait(self.queue_handler.aggregate.interval / 2):
+            self.queue_handler.report_expired()
+
 
+def start_queue_logging(logger: logging.Logger, handlers: list, interval: float = AGGREGATE_INTERVAL):
+    # Handlers run on the listener threads of the calling process. Processes forked afterwards inherit the
+    # queue handler, so logging calls only enqueue and never wait for formatting or disk I/O.
+    queue = Queue(-1)
+    queue_handler = AggregateQueueHandler(queue, interval=interval)
+    logger.addHandler(queue_handler)
 
+    listener = AggregateListener(queue, *handlers, queue_handler=queue_handler, respect_handler_level=True)
+    listener.start()
 
+    return listener
@@ -0,0 +1,116 @@
+import csv
+import io
+import zipfile
+
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+FORMATS = {'csv': 'text/csv', 'npz': 'application/octet-stream', 'parquet': 'application/vnd.apache.parquet'}
+
+# column types of the exported tables, everything else is a float
+INT_COLUMNS = ['channel', 'point']
+STR_COLUMNS = ['sweep_id', 'mode']
+
+
+class ExportError(Exception):
+    pass
+
+
+class _Sink:
+    # write-only file object, the stream generators hand out what the writers put in after every chunk
+    def __init__(self):
+        self.buffer = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.buffer.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self.buffer)
+        self.buffer.clear()
+        return data
+
+
+def _numpy_dtype(columns: list):
+    return np.dtype([(c, 'i8' if c in INT_COLUMNS else 'U32' if c in STR_COLUMNS else 'f8') for c in columns])
+
+
+def _arrow_schema(columns: list):
+    return pa.schema([(c, pa.int64() if c in INT_COLUMNS else pa.string() if c in STR_COLUMNS else pa.float64())
+                      for c in columns])
+
+
+def stream_csv(columns: list, chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for rows in chunks:
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+    yield buffer.getvalue()
+
+
+def stream_npz(columns: list, count: int, chunks):
+    # a single structured array 'data', the .npy header needs the row count before the first row
+    dtype = _numpy_dtype(columns)
+    floats = [k for k, c in enumerate(columns) if dtype[c].kind == 'f']
+    sink = _Sink()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as npz:
+        with npz.open('data.npy', 'w', force_zip64=True) as member:
+            np.lib.format.write_array_header_1_0(member, {'descr': np.lib.format.dtype_to_descr(dtype),
+                                                          'fortran_order': False, 'shape': (count,)})
+            for rows in chunks:
+                rows = [tuple(np.nan if v is None and k in floats else v for k, v in enumerate(row)) for row in rows]
+                member.write(np.array(rows, dtype=dtype).tobytes())
+                yield sink.drain()
+
+    yield sink.drain()
+
+
+def stream_parquet(columns: list, chunks):
+    # one row group per chunk
+    schema = _arrow_schema(columns)
+    sink = _Sink()
+    with pq.ParquetWriter(sink, schema) as writer:
+        for rows in chunks:
+            writer.write_table(pa.Table.from_arrays([pa.array(col, type=field.type)
+                                                     for col, field in zip(zip(*rows), schema)], schema=schema))
+            yield sink.drain()
+
+    yield sink.drain()
+
+
+def stream(fmt: str, columns: list, count: int, chunks):
+    if fmt not in FORMATS:
+        raise ExportError(f"Unknown export format '{fmt}', expected one of {list(FORMATS)}.")
+
+    if fmt == 'csv':
+        return stream_csv(columns, chunks)
+
+    elif fmt == 'npz':
+        return stream_npz(columns, count, chunks)
+
+    if pq is None:
+        raise ExportError("Parquet export requires pyarrow. Install it with 'pip install xld-server[parquet]'.")
+
+    return stream_parquet(columns, chunks)
@@ -0,0 +1,255 @@
+from multiprocessing import Event, Lock, Process
+from datetime import datetime
+import logging
+from time import monotonic
+
+from clock import Clock
+from controllers import make_controller
+from database_sqlite import ServerDB
+from notifier import ChangeNotifier
+from progress import ProgressBuffer, eta
+from scheduler import OPERATOR_HOLD, SweepScheduler
+from snapshot import SharedSnapshot
+from tempcomm import XLDTempHandler
+from temperature_sweep import TemperatureSweepManager, TemperatureSweep, SweepExecutor
+
+xld_logger = logging.getLogger('waitress')
+
+
+class Fridge:
+    # Everything the server keeps per cryostat: database file, controller process, snapshot, sweep manager and
+    # executor. Locks and notifiers are created here, the defaults of ServerDB are shared by all its instances.
+    def __init__(self, name: str, ip: str, db_name: str, backend: str = 'blueftc', update_interval: float = 5,
+                 clock: Clock = Clock()):
+        self.name = name
+        self.clock = clock
+        self.ip = ip
+        self.backend = backend
+        self.update_interval = update_interval
+
+        self.db = ServerDB(db_name=db_name, temp_lock=Lock(), heater_lock=Lock(), meas_notifier=ChangeNotifier(),
+                           heater_notifier=ChangeNotifier())
+        self.db.prep_tables()
+        self.db.clear_metrics()
+
+        # latest readings published by the temperature controller process, read by the flask routes
+        self.snapshot = SharedSnapshot(
+            temp_channels=[self.db.mxc_ch, self.db.still_ch, self.db.fourk_ch, self.db.fiftyk_ch],
+            heater_indices=[self.db.mxc_ind, self.db.still_ind, self.db.mxc_switch_ind, self.db.still_switch_ind])
+
+        self.sweep_manager = TemperatureSweepManager()
+        self.sweep_executor = SweepExecutor(name=f'{name} Sweep')
+        self.abort = Event()
+        self.sweep_running = Event()
+        self.progress = ProgressBuffer(clock=clock)
+        # sweeps from the queue start one after the other while it is not paused, aborting a sweep pauses it
+        self.scheduler = SweepScheduler(self)
+        self.queue_paused = False
+        self.start_lock = Lock()
+
+        self.process = Process(target=self.exec_tcontrol, name=f'{name} Controller')
+
+    def exec_tcontrol(self):
+        tccontrol = XLDTempHandler(database=self.db, ip=self.ip, update_interval=self.update_interval,
+                                   snapshot=self.snapshot,
+                                   controller=make_controller(self.backend, ip=self.ip, db=self.db))
+        tccontrol.exec()
+
+    def make_sweep(self, test_mode: bool = False, sweep_id: str = None, start_point: int = 0):
+        manager = self.sweep_manager
+        settle_tol = manager.settle_tol / 100 if manager.adaptive else None
+        setpoints = manager.sweep_array / 1000 if manager.mode == 'pid' else None
+        return TemperatureSweep(thermalization_time=float(manager.therm_time) * 60,
+                                power_array=manager.sweep_array,
+                                client_timeout=float(manager.cl_timeout) * 60,
+                                abort_flag=self.abort, is_running=self.sweep_running,
+                                test_mode=test_mode,
+                                return_to_base=manager.return_to_base,
+                                skip_first=manager.skip_first, database=self.db,
+                                settle_tolerance=settle_tol,
+                                min_thermalization_time=manager.min_therm_time * 60,
+                                setpoints=setpoints, pid_gains=manager.pid_gains,
+                                max_power=manager.pid_max_pow, sweep_id=sweep_id,
+                                params=manager.params, start_point=start_point,
+                                client_group=manager.client_group)
+
+    def start_sweep(self, t_sweep: TemperatureSweep):
+        # set before start_sweep wakes the info waiters, which clear the manager if no sweep is running
+        self.sweep_running.set()
+        self.sweep_manager.start_sweep()
+        self.sweep_executor.start(t_sweep)
+
+    def registration_open(self, group: str):
+        # clients outside the group of a running job register for the jobs queued after it
+        manager = self.sweep_manager
+        return not manager.started or manager.client_group not in (None, group)
+
+    def resume_sweep(self, enabled: bool = True, test_mode: bool = False):
+        unfinished = self.db.read_unfinished_sweeps()
+        # only the latest one, older ones were already given up by a previous start
+        for sweep_id, params, completed, n_points in unfinished[1:]:
+            self.db.set_sweep_state(sweep_id, 'interrupted')
+
+        if not unfinished:
+            return
+
+        sweep_id, params, completed, n_points = unfinished[0]
+        if not enabled or params is None or completed >= n_points:
+            self.db.set_sweep_state(sweep_id, 'interrupted')
+            return
+
+        try:
+            self.sweep_manager.generate_sweep_array(params=params)
+        except (AssertionError, KeyError, ValueError) as ex:
+            xld_logger.warning(f'FLASK SERVER: Cannot resume sweep {sweep_id} on {self.name}: {ex}')
+            self.db.set_sweep_state(sweep_id, 'interrupted')
+            return
+
+        xld_logger.info(f'FLASK SERVER: Resuming sweep {sweep_id} on {self.name} after {completed} of '
+                        f'{n_points} points.')
+        self.sweep_manager.confirm()
+        self.start_sweep(self.make_sweep(test_mode=test_mode, sweep_id=sweep_id, start_point=completed))
+
+    def estimate_sweep_duration(self, manager: TemperatureSweepManager):
+        # thermalization plus the mean measurement time of earlier sweep points, the client timeout without any
+        measure_time = self.db.mean_point_duration()
+        measure_time = float(manager.cl_timeout) * 60 if measure_time is None else measure_time
+        n_points = len(manager.sweep_array)
+        n_thermalizations = n_points - 1 if manager.skip_first else n_points
+
+        return n_thermalizations * float(manager.therm_time) * 60 + n_points * measure_time
+
+    def queue_sweep(self, params: dict, name: str = None, client_group: str = None, priority: int = 0,
+                    min_clients: int = 0, est_duration: float = None):
+        params = dict(params, client_group=client_group or None)
+        # rejects invalid params now instead of when the job is due
+        manager = TemperatureSweepManager()
+        manager.generate_sweep_array(params=params)
+        est_duration = self.estimate_sweep_duration(manager) if est_duration is None else float(est_duration)
+
+        job_id = self.db.enqueue_sweep(params, name=name, client_group=params['client_group'], priority=int(priority),
+                                       min_clients=int(min_clients), est_duration=est_duration)
+        self.scheduler.wake()
+
+        return job_id, est_duration
+
+    def get_sweep_queue(self):
+        # expected start times assume every job takes its estimated duration
+        jobs = self.db.read_sweep_queue()
+        now = self.clock.time()
+        start = now
+        for job in jobs:
+            if job['state'] == 'started':
+                if job['est_duration'] is not None:
+                    start = max(start, job['start_time'] + job['est_duration'])
+            else:
+                job['expected_start'] = start
+                start += job['est_duration'] or 0
+
+        return jobs
+
+    def start_queued_sweep(self, test_mode: bool = False):
+        with self.start_lock:
+            # clears the manager of a sweep that ended since the last request
+            self.get_sweep_info()
+            manager = self.sweep_manager
+            if (self.queue_paused or self.sweep_running.is_set() or self.sweep_executor.busy or self.abort.is_set()
+                    or manager.confirmed or manager.started):
+                return None
+
+            # params generated on the sweep page but not broadcast yet, given up after OPERATOR_HOLD
+            if manager.generated_at is not None:
+                if monotonic() - manager.generated_at < OPERATOR_HOLD:
+                    return None
+                xld_logger.info(f'TEMPERATURE CONTROL: Discarding sweep params on {self.name} generated but not '
+                                f'broadcast for {OPERATOR_HOLD / 60:.0f} minutes.')
+                manager.clear()
+
+            for job in self.db.read_sweep_queue():
+                # jobs still waiting for their clients let the ones after them go first
+                if job['state'] != 'queued' or self.db.count_meas(group=job['client_group']) < job['min_clients']:
+                    continue
+
+                try:
+                    manager.generate_sweep_array(params=job['params'])
+                except (AssertionError, KeyError, ValueError) as ex:
+                    xld_logger.warning(f"TEMPERATURE CONTROL: Cannot start sweep job {job['job_id']} on {self.name}: "
+                                       f"{ex}")
+                    self.db.cancel_sweep_job(job['job_id'])
+                    manager.clear()
+                    continue
+
+                sweep_id = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-job{job['job_id']}"
+                xld_logger.info(f"TEMPERATURE CONTROL: Starting sweep job {job['job_id']} ({job['name']}) on "
+                                f"{self.name} as sweep {sweep_id}.")
+                manager.confirm()
+                t_sweep = self.make_sweep(test_mode=test_mode, sweep_id=sweep_id)
+                self.db.set_sweep_job_started(job['job_id'], sweep_id)
+                self.start_sweep(t_sweep)
+
+                return job['job_id']
+
+    def get_sweep_info(self, meas: list = None):
+        # meas from get_meas_dicts saves reading the clients again
+        manager = self.sweep_manager
+        if not self.sweep_running.is_set() and manager.started:
+            manager.clear()
+            return {'abort_in_progress': False, 'confirmed': False, 'sweep_started': False}
+
+        elif manager.confirmed and manager.started:
+            return dict(manager.client_dict, point_eta=self.point_eta(meas))
+
+        elif manager.confirmed:
+            return manager.client_dict
+
+        elif manager.started:
+            return {'abort_in_progress': False, 'confirmed': True, 'sweep_started': True}
+
+        elif self.abort.is_set() and self.sweep_running.is_set():
+            return {'abort_in_progress': True}
+
+        else:
+            return {'abort_in_progress': False, 'confirmed': False, 'sweep_started': False}
+
+    def get_meas_dicts(self, meas_id=None):
+        # client rows with the progress reports not yet flushed to the database and the estimated time left
+        if meas_id is None:
+            meas = self.db.get_html_meas_dict()
+        else:
+            meas = [m for m in [self.db.get_single_meas_dict(meas_id)] if m is not None]
+
+        pending = self.progress.latest()
+        now = self.clock.time()
+        for m in meas:
+            if m['id'] in pending and m['running']:
+                progress, tstamp = pending[m['id']]
+                if tstamp >= (m['point_start'] or 0) and tstamp >= (m['progress_time'] or 0):
+                    m['progress'], m['progress_time'] = progress, tstamp
+            m['eta'] = eta(m['progress'], m['progress_time'], m['point_start'], now) if m['running'] else None
+
+        return meas
+
+    def point_eta(self, meas: list = None):
+        # the current sweep point is done when its slowest measurement is
+        meas = self.get_meas_dicts() if meas is None else meas
+        etas = [m['eta'] for m in meas if m['running'] and not m['crashed']]
+        if not etas or None in etas:
+            return None
+
+        return max(etas)
+
+    def get_all_temps(self):
+        _, latest, _ = self.snapshot.read()
+        channels = {'mxc': self.db.mxc_ch, 'still': self.db.still_ch, 'four_k': self.db.fourk_ch,
+                    'fifty_k': self.db.fiftyk_ch}
+        temps = {name: latest[ch][0] if ch in latest else self.db.read_temp(ch) for name, ch in channels.items()}
+
+        return temps
+
+    def get_all_powers(self):
+        _, _, latest = self.snapshot.read()
+        heaters = {'mxc': self.db.mxc_ind, 'still': self.db.still_ind, 'mxc_switch': self.db.mxc_switch_ind,
+                   'still_switch': self.db.still_switch_ind}
+        powers = {name: latest[i][0] if i in latest else self.db.read_heater(i) for name, i in heaters.items()}
+
+        return powers
@@ -1,17 +1,31 @@
 import logging
 import sys
 from logging.handlers import TimedRotatingFileHandler
-from multiprocessing import Process, Event
+from multiprocessing import Process
 
 from waitress import serve
 
-from flask import Flask, request, render_template, redirect, flash
+from flask import Flask, Blueprint, request, render_template, redirect, flash, g, abort as http_abort
 import flask_login
 from flask_login import LoginManager, UserMixin
 import json
+import hashlib
+from datetime import datetime, timedelta
+from time import perf_counter
 
 import os
-from passkey import key, users, blueftc_ip, xld_ip, data_dir
+import passkey
+from passkey import key, users, blueftc_ip, xld_ip, data_dir, db_filename
+
+controller_backend = getattr(passkey, 'controller_backend', 'blueftc')
+# continue a sweep interrupted by a server restart after its last finished point
+resume_sweeps = getattr(passkey, 'resume_sweeps', True)
+# start queued sweeps as soon as a fridge is idle, otherwise the queue waits until it is resumed in the web UI
+run_sweep_queue = getattr(passkey, 'run_sweep_queue', True)
+# client processes connected at the same time over all fridges, sets the number of server threads
+max_clients = int(getattr(passkey, 'max_clients', 24))
+# {name: {'ip': ..., 'backend': ..., 'db_filename': ...}}, without it a single fridge at blueftc_ip
+fridge_config = getattr(passkey, 'fridges', {'xld': {'ip': blueftc_ip, 'db_filename': db_filename}})
 
 if not os.path.isdir(data_dir):
     try:
@@ -21,38 +35,52 @@ if not os.path.isdir(data_dir):
         print(ex)
         sys.exit()
 
-from tempcomm import XLDTempHandler
-from database_sqlite import ServerDB
-from temperature_sweep import TemperatureSweepManager, TemperatureSweep
-
-db = ServerDB()
-db.prep_tables()
+from database_sqlite import to_epoch
+from temperature_sweep import SETTLE_WINDOW
+from fridge import Fridge
+from notifier import wait_for_change
+from event_logger import log_formatter, start_queue_logging
+from metrics import metrics, render as render_metrics
+from export import FORMATS, ExportError, stream as stream_export
+
+fridges = {name: Fridge(name, ip=config['ip'], backend=config.get('backend', controller_backend),
+                        db_name=os.path.join(data_dir, config.get('db_filename', f'{name}.db')),
+                        update_interval=config.get('update_interval', 5))
+           for name, config in fridge_config.items()}
+# served by the routes without the /fridge/<name> prefix, which single-fridge clients use
+default_fridge = fridges[getattr(passkey, 'default_fridge', next(iter(fridges)))]
 
 app = Flask(__name__)
 app.secret_key = key
 
+# per-fridge routes, registered once under /fridge/<fridge> and once without prefix for the default fridge
+fridge_bp = Blueprint('fridge', __name__)
+
 login_manager = LoginManager()
 login_manager.login_view = 'login'
 login_manager.init_app(app)
 
-t_sweep_manager = TemperatureSweepManager()
-
-abort = Event()
-sweep_running = Event()
-
-log_formatter = logging.Formatter("%(asctime)s [%(threadName)-12.12s] [%(levelname)-5.5s]  %(message)s")
 log_file = os.path.join(data_dir, "xld_events.log")
 noop = logging.NullHandler()
 logging.getLogger().addHandler(noop)
 wrkzg_logger = logging.getLogger('waitress')
 
+# long-poll requests each hold a worker thread for up to LONG_POLL_TIMEOUT, one per client process over all fridges.
+# Beyond max_clients, heartbeats and status posts queue behind the long-polls, the headroom serves them and the web UI.
+SERVER_THREAD_HEADROOM = 8
+SERVER_THREADS = max_clients + SERVER_THREAD_HEADROOM
+LONG_POLL_TIMEOUT = 25
+LONG_POLL_MAX_TIMEOUT = 60
+# fields of /state that change on every poll during a sweep, left out of its ETag
+STATE_VOLATILE = ('eta', 'point_eta', 'last_seen')
+
 
 class User(UserMixin):
     def __init__(self, id):
         self.id = id
 
 
-def exec_flask():
+def setup_logging():
     file_handler = TimedRotatingFileHandler(log_file, when='W0')
     file_handler.setFormatter(log_formatter)
     file_handler.setLevel(logging.INFO)
@@ -65,14 +93,19 @@ def exec_flask():
     flask_file_handler.setFormatter(log_formatter)
     flask_file_handler.setLevel(logging.INFO)
 
-    wrkzg_logger.addHandler(flask_file_handler)
-    wrkzg_logger.addHandler(file_handler)
-    wrkzg_logger.addHandler(console_handler)
+    # handlers run on a listener thread in the parent process, the server, temperature controller and sweep
+    # processes only put records on the queue
+    wrkzg_logger.setLevel(logging.INFO)
+    return start_queue_logging(wrkzg_logger, [flask_file_handler, file_handler, console_handler])
 
-    app.config['TEMPLATES_AUTO_RELOAD'] = True
 
-    wrkzg_logger.setLevel(logging.INFO)
-    serve(app, host=xld_ip)
+def exec_flask():
+    app.config['TEMPLATES_AUTO_RELOAD'] = True
+    for fridge in fridges.values():
+        fridge.resume_sweep(enabled=resume_sweeps, test_mode=app.config.get('SWEEP_TEST_MODE', False))
+        fridge.queue_paused = not run_sweep_queue
+        fridge.scheduler.start(test_mode=app.config.get('SWEEP_TEST_MODE', False))
+    serve(app, host=xld_ip, threads=SERVER_THREADS)
 
 
 @login_manager.user_loader
@@ -80,113 +113,217 @@ def load_user(user_id):
     return User(user_id)
 
 
-@app.route("/meas/register", methods=['POST'])
+@app.before_request
+def start_request_timer():
+    g.request_start = perf_counter()
+
+
+@app.after_request
+def observe_request_time(response):
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    metrics.observe('xld_http_request_seconds', perf_counter() - g.request_start, endpoint=endpoint,
+                    method=request.method, status=response.status_code)
+
+    return response
+
+
+@fridge_bp.url_value_preprocessor
+def select_fridge(endpoint, values):
+    name = values.pop('fridge', None) if values else None
+    g.fridge = default_fridge if name is None else fridges.get(name)
+    g.base = '' if name is None else f'/fridge/{name}'
+
+
+@fridge_bp.before_request
+def require_fridge():
+    # after the request timer of the app started
+    if g.fridge is None:
+        http_abort(404)
+
+
+@app.context_processor
+def inject_fridge():
+    # templates prefix their links with base, so the pages of a fridge link to the same fridge
+    return {'base': g.get('base', ''), 'fridge': (g.get('fridge') or default_fridge).name, 'fridges': list(fridges)}
+
+
+@fridge_bp.route("/meas/register", methods=['POST'])
 def meas_reg():
-    if not t_sweep_manager.started:
-        cont = json_request_handler()
-        token = db.register_measurement(user=cont['user'], group=cont['group'])
+    fridge = g.fridge
+    cont = json_request_handler()
+    if fridge.registration_open(group=cont['group']):
+        token = fridge.db.register_measurement(user=cont['user'], group=cont['group'])
 
         return json.dumps({'id': token})
 
     else:
-        return json.dumps({'error': 'ERROR! Sweep already started.'})
+        return json.dumps({'error': 'ERROR! Sweep for this group already started.'})
 
 
-@app.route("/meas/deregister", methods=['POST'])
+@fridge_bp.route("/meas/deregister", methods=['POST'])
 def meas_dereg():
     cont = json_request_handler()
-    db.deregister_measurement(meas_id=cont['id'])
+    g.fridge.progress.flush_meas(g.fridge.db, [cont['id']])
+    # False for unknown ids
+    deregistered = g.fridge.db.deregister_measurement(meas_id=cont['id'])
 
-    return json.dumps({'deregistered': True})
+    return json.dumps({'deregistered': deregistered})
 
 
-@app.route('/temperature-sweep', methods=['GET'])
+# batch versions for processes running several measurements, one request and one transaction for all their ids
+@fridge_bp.route("/meas/register/batch", methods=['POST'])
+def meas_reg_batch():
+    fridge = g.fridge
+    cont = json_request_handler()
+    if fridge.registration_open(group=cont['group']):
+        tokens = fridge.db.register_measurements(user=cont['user'], group=cont['group'], count=int(cont['count']))
+
+        return json.dumps({'ids': tokens})
+
+    else:
+        return json.dumps({'error': 'ERROR! Sweep for this group already started.'})
+
+
+@fridge_bp.route("/meas/deregister/batch", methods=['POST'])
+def meas_dereg_batch():
+    cont = json_request_handler()
+    g.fridge.progress.flush_meas(g.fridge.db, cont['ids'])
+
+    return json.dumps({'deregistered': g.fridge.db.deregister_measurements(meas_ids=cont['ids'])})
+
+
+@fridge_bp.route('/temperature-sweep', methods=['GET'])
 @flask_login.login_required
 def temperature_sweep():
     if request.method == 'GET':
-        return render_template('temperature_sweep.html', sweep=t_sweep_manager.html_dict)
+        return render_template('temperature_sweep.html', sweep=g.fridge.sweep_manager.html_dict,
+                               queue=g.fridge.get_sweep_queue(), queue_paused=g.fridge.queue_paused,
+                               settle_window_min=SETTLE_WINDOW / 60)
 
 
-@app.route('/temperature-sweep/generate', methods=['POST'])
+@fridge_bp.route('/temperature-sweep/generate', methods=['POST'])
 @flask_login.login_required
 def generate_temp_sweep():
     payload = json_request_handler()
+    fridge = g.fridge
 
-    t_sweep_manager.generate_sweep_array(params=payload)
+    # the scheduler uses the same manager for sweeps from the queue
+    with fridge.start_lock:
+        if fridge.sweep_manager.confirmed or fridge.sweep_manager.started:
+            return json.dumps({'error': 'A sweep is already broadcast or running.'})
+        fridge.sweep_manager.generate_sweep_array(params=payload)
 
-    return json.dumps(t_sweep_manager.html_dict)
+        return json.dumps(fridge.sweep_manager.html_dict)
 
 
-@app.route('/temperature-sweep/broadcast-start', methods=['POST'])
+@fridge_bp.route('/temperature-sweep/broadcast-start', methods=['POST'])
 @flask_login.login_required
 def broadcast_temp_sweep():
     payload = json_request_handler()
+    fridge = g.fridge
 
     if payload['broadcast']:
-        t_sweep_manager.confirm()
+        with fridge.start_lock:
+            if fridge.sweep_manager.confirmed:
+                return json.dumps({'confirmed': False, 'error': 'A sweep is already broadcast or running.'})
+            fridge.sweep_manager.confirm()
+
         return json.dumps({'confirmed': True, 'started': False})
 
     elif payload['start']:
-        if not t_sweep_manager.started and not sweep_running.is_set():
-            t_sweep = TemperatureSweep(thermalization_time=float(t_sweep_manager.therm_time) * 60,
-                                       power_array=t_sweep_manager.sweep_array,
-                                       client_timeout=float(t_sweep_manager.cl_timeout) * 60,
-                                       abort_flag=abort, is_running=sweep_running, test_mode=False,
-                                       return_to_base=t_sweep_manager.return_to_base,
-                                       skip_first=t_sweep_manager.skip_first)
-            t_sweep_manager.start_sweep()
-            sweep_running.set()
-            t_sweep_process = Process(target=t_sweep.exec(), name='Temperature Sweep')
-            t_sweep_process.start()
+        with fridge.start_lock:
+            if (not fridge.sweep_manager.started and not fridge.sweep_running.is_set()
+                    and not fridge.sweep_executor.busy):
+                fridge.start_sweep(fridge.make_sweep(test_mode=app.config.get('SWEEP_TEST_MODE', False)))
 
         return json.dumps({'confirmed': True, 'sweep_started': True})
 
 
-@app.route('/temperature-sweep/abort', methods=['GET'])
+@fridge_bp.route('/temperature-sweep/abort', methods=['GET'])
 @flask_login.login_required
 def abort_temp_sweep():
-    if t_sweep_manager.started and sweep_running.is_set():
-        wrkzg_logger.info('FLASK SERVER: Abort sweep initiated.')
-        abort.set()
-        t_sweep_manager.clear()
+    fridge = g.fridge
+    if fridge.sweep_manager.started and fridge.sweep_running.is_set():
+        wrkzg_logger.info(f'FLASK SERVER: Abort sweep on {fridge.name} initiated, sweep queue paused.')
+        fridge.queue_paused = True
+        fridge.abort.set()
+        fridge.db.meas_notifier.notify()
+        fridge.sweep_manager.clear()
         return json.dumps({'aborted': False, 'initiated': True})
 
-    elif not sweep_running.is_set():
-        wrkzg_logger.info("FLASK SERVER: Abort confirmed.")
-        abort.clear()
+    elif not fridge.sweep_running.is_set():
+        wrkzg_logger.info(f"FLASK SERVER: Abort on {fridge.name} confirmed.")
+        fridge.abort.clear()
         return json.dumps({'aborted': True, 'initiated': True})
 
     else:
         return json.dumps({'aborted': False, 'initiated': False})
 
 
-@app.route('/temperature-sweep/info', methods=['GET'])
+@fridge_bp.route('/temperature-sweep/info', methods=['GET'])
 # @flask_login.login_required
 def info_temp_sweep():
-    # print('confirmed:', t_sweep_manager.confirmed, '-- started: ', t_sweep_manager.started)
-    # print('abort event: ', abort.is_set(), '-- running event: ', sweep_running.is_set())
-    if not sweep_running.is_set() and t_sweep_manager.started:
-        t_sweep_manager.clear()
-        return json.dumps({'abort_in_progress': False, 'confirmed': False, 'sweep_started': False})
+    return json.dumps(g.fridge.get_sweep_info())
 
-    elif t_sweep_manager.confirmed:
-        return json.dumps(t_sweep_manager.client_dict)
 
-    elif t_sweep_manager.started:
-        return json.dumps({'abort_in_progress': False, 'confirmed': True, 'sweep_started': True})
+@fridge_bp.route('/temperature-sweep/info/wait', methods=['GET'])
+def wait_info_temp_sweep():
+    fridge = g.fridge
+    # clients pass their group to skip sweeps of the queue meant for other groups
+    group = request.args.get('group')
+    info = wait_for_change(fridge.sweep_manager.changed, read=fridge.get_sweep_info,
+                           done=lambda info: info.get('confirmed') and info.get('client_group') in (None, group),
+                           timeout=long_poll_timeout(request.args.get('timeout')))
 
-    elif abort.is_set() and sweep_running.is_set():
-        return json.dumps({'abort_in_progress': True})
-
-    else:
-        return json.dumps({'abort_in_progress': False, 'confirmed': False, 'sweep_started': False})
+    return json.dumps(info)
 
 
-@app.route('/temperature-sweep/params', methods=['GET'])
+@fridge_bp.route('/temperature-sweep/params', methods=['GET'])
 @flask_login.login_required
 def params_temp_sweep():
-    if t_sweep_manager.confirmed:
-        return json.dumps(t_sweep_manager.html_dict)
+    if g.fridge.sweep_manager.confirmed:
+        return json.dumps(g.fridge.sweep_manager.html_dict)
+
+
+@fridge_bp.route('/temperature-sweep/queue', methods=['GET'])
+def queue_temp_sweep():
+    return json.dumps({'paused': g.fridge.queue_paused, 'jobs': g.fridge.get_sweep_queue()})
+
+
+@fridge_bp.route('/temperature-sweep/queue/add', methods=['POST'])
+@flask_login.login_required
+def queue_add_temp_sweep():
+    payload = json_request_handler()
+    try:
+        job_id, est_duration = g.fridge.queue_sweep(params=payload['params'], name=payload.get('name'),
+                                                    client_group=payload.get('client_group'),
+                                                    priority=payload.get('priority', 0),
+                                                    min_clients=payload.get('min_clients', 0),
+                                                    est_duration=payload.get('est_duration'))
+    except (AssertionError, KeyError, ValueError) as ex:
+        return json.dumps({'error': f'Invalid sweep parameters: {ex!r}'})
+
+    return json.dumps({'job_id': job_id, 'est_duration': est_duration})
+
+
+@fridge_bp.route('/temperature-sweep/queue/cancel', methods=['POST'])
+@flask_login.login_required
+def queue_cancel_temp_sweep():
+    payload = json_request_handler()
+
+    return json.dumps({'cancelled': g.fridge.db.cancel_sweep_job(int(payload['job_id']))})
+
+
+@fridge_bp.route('/temperature-sweep/queue/pause', methods=['POST'])
+@flask_login.login_required
+def queue_pause_temp_sweep():
+    payload = json_request_handler()
+    fridge = g.fridge
+    fridge.queue_paused = bool(payload['paused'])
+    wrkzg_logger.info(f"FLASK SERVER: Sweep queue on {fridge.name} {'paused' if fridge.queue_paused else 'resumed'}.")
+    fridge.scheduler.wake()
+
+    return json.dumps({'paused': fridge.queue_paused})
 
 
 @app.route("/login", methods=["GET", "POST"])
@@ -205,37 +342,80 @@ def login():
     return render_template("login.html")
 
 
-@app.route('/meas/status', methods=['GET', 'POST'])
+@fridge_bp.route('/meas/status', methods=['GET', 'POST'])
 @flask_login.login_required
 def meas_status_get():
+    db = g.fridge.db
     if request.method == 'GET':
-        return render_template('measurements.html', measurements=db.get_html_meas_dict())
+        return render_template('measurements.html', measurements=g.fridge.get_meas_dicts(),
+                               point_eta=g.fridge.point_eta())
 
     else:
         payload = json_request_handler()
         if 'start' in payload.keys() and payload['start']:
             db.set_all_meas_to_go()
             flash("All signal flags set to GO")
-            return redirect('/meas/status')
+            return redirect(f'{g.base}/meas/status')
 
         elif 'delete' in payload.keys() and payload['delete']:
             meas_info = db.get_single_meas_dict(meas_id=payload['meas_id'])
             db.deregister_measurement(meas_id=meas_info['id'])
             flash(f"Deleted measurement client")  # run by {meas_info['user']} ({meas_info['group']})")
-            return redirect('/meas/status')
+            return redirect(f'{g.base}/meas/status')
 
 
-@app.route('/meas/status/set', methods=['POST'])
+@fridge_bp.route('/meas/status/set', methods=['POST'])
 def meas_status_set_post():
     payload = json_request_handler()
-    if not db.get_single_meas_dict(meas_id=payload['id'])['crashed']:
-        db.set_meas_status(meas_id=payload['id'], status=payload['running'])
-    else:
-        pass
+    g.fridge.progress.flush_meas(g.fridge.db, [payload['id']])
+    g.fridge.db.set_meas_status(meas_id=payload['id'], status=payload['running'], skip_crashed=True)
 
     return json.dumps({'running': True})
 
 
+@fridge_bp.route('/meas/status/set/batch', methods=['POST'])
+def meas_status_set_batch():
+    payload = json_request_handler()
+    g.fridge.progress.flush_meas(g.fridge.db, payload['ids'])
+    updated = g.fridge.db.set_meas_statuses(meas_ids=payload['ids'], status=payload['running'], skip_crashed=True)
+
+    return json.dumps({'running': True, 'updated': updated})
+
+
+@fridge_bp.route('/meas/heartbeat', methods=['POST'])
+def meas_heartbeat():
+    payload = json_request_handler()
+    alive = g.fridge.db.write_heartbeats(meas_ids=payload['ids'], interval=float(payload['interval']))
+
+    return json.dumps({'alive': alive})
+
+
+@fridge_bp.route('/meas/progress', methods=['POST'])
+def meas_progress():
+    payload = json_request_handler()
+    g.fridge.progress.report(g.fridge.db, {payload['id']: payload['progress']})
+
+    return json.dumps({'received': True})
+
+
+@fridge_bp.route('/meas/progress/batch', methods=['POST'])
+def meas_progress_batch():
+    payload = json_request_handler()
+    g.fridge.progress.report(g.fridge.db, payload['progress'])
+
+    return json.dumps({'received': len(payload['progress'])})
+
+
+@fridge_bp.route('/meas/progress/info', methods=['POST'])
+def meas_progress_info():
+    payload = json_request_handler()
+    meas = g.fridge.get_meas_dicts(meas_id=payload['id'])
+    if not meas:
+        return json.dumps({'error': f"Unknown measurement id {payload['id']}."})
+
+    return json.dumps({key: meas[0][key] for key in ['id', 'running', 'progress', 'progress_time', 'eta']})
+
+
 @app.route('/logout')
 @flask_login.login_required
 def logout():
@@ -244,38 +424,191 @@ def logout():
     return redirect('/')
 
 
-@app.route("/control", methods=["GET", "POST"])
+@fridge_bp.route("/control", methods=["GET", "POST"])
 @flask_login.login_required
 def control():
-    if sweep_running.is_set():
+    fridge = g.fridge
+    if fridge.sweep_running.is_set():
         return render_template("not_available.html")
 
     if request.method == "POST":
         new_power = request.form.get("power")
         heater_id = request.form.get("heater select")
         if heater_id == 'mixing chamber':
-            db.write_heater(index=db.mxc_ind, val=float(new_power))
-            return redirect('/control')
+            fridge.db.write_heater(index=fridge.db.mxc_ind, val=float(new_power))
+            return redirect(f'{g.base}/control')
 
     else:
-        return render_template("control.html", powers=get_all_powers(), temps=get_all_temps())
+        return render_template("control.html", powers=fridge.get_all_powers(), temps=fridge.get_all_temps())
 
 
-@app.route('/temps/mxc', methods=['GET'])
+@fridge_bp.route('/temps/mxc', methods=['GET'])
 def get_base_temp():
-    return json.dumps({'mxc_temp': db.read_temp(channel=db.mxc_ch)})
+    db = g.fridge.db
+    _, temps, _ = g.fridge.snapshot.read()
+    return json.dumps({'mxc_temp': temps[db.mxc_ch][0] if db.mxc_ch in temps else db.read_temp(channel=db.mxc_ch)})
+
+
+@fridge_bp.route('/temps/history', methods=['GET'])
+def get_temp_history():
+    db = g.fridge.db
+    try:
+        channel = int(request.args.get('channel', db.mxc_ch))
+        end = to_epoch(request.args.get('end', datetime.now()))
+        start = to_epoch(request.args.get('start', end - timedelta(days=1).total_seconds()))
+    except ValueError as ex:
+        return json.dumps({'error': f'ERROR! Invalid history query: {ex}'}), 400
+
+    history = db.read_temp_history(channel=channel, start=start, end=end)
+
+    return json.dumps({'channel': channel, 'start': start, 'end': end,
+                       'tstamps': [row[0] for row in history], 'temps': [row[1] for row in history]})
+
+
+@fridge_bp.route('/temps/history/downsampled', methods=['GET'])
+def get_downsampled_temp_history():
+    # at most points readings per channel, for plots of long windows
+    db = g.fridge.db
+    try:
+        channels = [int(ch) for ch in request.args.get('channels', str(db.mxc_ch)).split(',')]
+        points = int(request.args.get('points', 1000))
+        end = to_epoch(request.args.get('end', datetime.now()))
+        start = to_epoch(request.args.get('start', end - timedelta(days=1).total_seconds()))
+        if points < 2:
+            raise ValueError('points must be at least 2')
+    except ValueError as ex:
+        return json.dumps({'error': f'ERROR! Invalid history query: {ex}'}), 400
+
+    result = {}
+    for channel in channels:
+        width, tstamps, temps = db.read_temp_history_downsampled(channel=channel, start=start, end=end,
+                                                                 max_points=points)
+        result[channel] = {'resolution': width, 'tstamps': tstamps.tolist(), 'temps': temps.tolist()}
+
+    return json.dumps({'start': start, 'end': end, 'channels': result})
+
+
+def export_response(fmt: str, name: str, export):
+    columns, count, chunks, close = export
+    try:
+        body = stream_export(fmt, columns, count, chunks)
+    except ExportError:
+        close()
+        raise
+
+    response = app.response_class(body, mimetype=FORMATS[fmt],
+                                  headers={'Content-Disposition': f'attachment; filename={name}.{fmt}'})
+    # also when the client disconnects before the first chunk
+    response.call_on_close(close)
+
+    return response
+
+
+@fridge_bp.route('/export/temps', methods=['GET'])
+def export_temps():
+    fridge = g.fridge
+    try:
+        channel = request.args.get('channel')
+        channel = None if channel is None else int(channel)
+        end = to_epoch(request.args.get('end', datetime.now()))
+        start = to_epoch(request.args.get('start', end - timedelta(days=1).total_seconds()))
+        fmt = request.args.get('format', 'csv')
+        return export_response(fmt, f'{fridge.name}-temps',
+                               fridge.db.export_temp_history(start=start, end=end, channel=channel))
+    except (ValueError, ExportError) as ex:
+        return json.dumps({'error': f'ERROR! Invalid export query: {ex}'}), 400
+
+
+@fridge_bp.route('/export/sweep-points', methods=['GET'])
+def export_sweep_points():
+    fridge = g.fridge
+    sweep_id = request.args.get('sweep_id')
+    name = f'{fridge.name}-sweep-points' if sweep_id is None else f'{fridge.name}-sweep-{sweep_id}'
+    try:
+        fmt = request.args.get('format', 'csv')
+        return export_response(fmt, name, fridge.db.export_sweep_points(sweep_id=sweep_id))
+    except ExportError as ex:
+        return json.dumps({'error': f'ERROR! Invalid export query: {ex}'}), 400
+
+
+@fridge_bp.route('/state', methods=['GET'])
+def get_state():
+    fridge = g.fridge
+    # temperatures and powers come from the snapshot, the clients table is the only database read
+    meas = fridge.get_meas_dicts()
+    # ids authorize the requests of a measurement, this view needs no login
+    clients = [{key: value for key, value in m.items() if key != 'id'} for m in meas]
+    state = {'temps': fridge.get_all_temps(), 'powers': fridge.get_all_powers(), 'sweep': fridge.get_sweep_info(meas),
+             'clients': clients}
+    body = json.dumps(state, sort_keys=True)
+    # polls get 304 until the state the estimates derive from changes
+    stable = dict(state, clients=[{key: value for key, value in c.items() if key not in STATE_VOLATILE}
+                                  for c in clients],
+                  sweep={key: value for key, value in state['sweep'].items() if key not in STATE_VOLATILE})
+
+    response = app.response_class(body, mimetype='application/json')
+    response.set_etag(hashlib.sha1(json.dumps(stable, sort_keys=True).encode()).hexdigest())
+
+    return response.make_conditional(request)
+
+
+@app.route('/fridges', methods=['GET'])
+def get_fridges():
+    return json.dumps({name: {'default': fridge is default_fridge, 'mxc_temp': fridge.get_all_temps()['mxc'],
+                              'sweep_running': fridge.sweep_running.is_set()}
+                       for name, fridge in fridges.items()})
 
 
-@app.route('/meas/signal', methods=['POST'])
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    # the other processes flush on their own schedule, this one right before reading
+    metrics.flush(default_fridge.db, force=True)
+    rows = [row for fridge in fridges.values() for row in fridge.db.read_metrics()]
+
+    return app.response_class(render_metrics(rows), mimetype='text/plain; version=0.0.4')
+
+
+@fridge_bp.route('/meas/signal', methods=['POST'])
 def get_meas_signal():
     payload = json_request_handler()
 
-    return json.dumps({'signal': db.get_meas_signal(payload['id'])})
+    return json.dumps({'signal': g.fridge.db.get_meas_signal(payload['id'])})
+
+
+@fridge_bp.route('/meas/signal/wait', methods=['POST'])
+def wait_meas_signal():
+    payload = json_request_handler()
+    db = g.fridge.db
+    signal = wait_for_change(db.meas_notifier, read=lambda: db.get_meas_signal(payload['id']),
+                             done=lambda current: current != payload.get('signal'),
+                             timeout=long_poll_timeout(payload.get('timeout')))
+
+    return json.dumps({'signal': signal})
 
 
-@app.route('/', methods=['GET'])
+@fridge_bp.route('/meas/signal/batch', methods=['POST'])
+def get_meas_signals():
+    payload = json_request_handler()
+
+    return json.dumps({'signals': g.fridge.db.get_meas_signals(payload['ids'])})
+
+
+@fridge_bp.route('/meas/signal/wait/batch', methods=['POST'])
+def wait_meas_signals():
+    # returns as soon as any of the signals differs from the one the client last saw
+    payload = json_request_handler()
+    db = g.fridge.db
+    seen = payload.get('signals') or {}
+    signals = wait_for_change(db.meas_notifier, read=lambda: db.get_meas_signals(payload['ids']),
+                              done=lambda current: any(current.get(i) != seen.get(i) for i in payload['ids']),
+                              timeout=long_poll_timeout(payload.get('timeout')))
+
+    return json.dumps({'signals': signals})
+
+
+@fridge_bp.route('/', methods=['GET'])
 def index():
-    return render_template('home.html', temps=get_all_temps(), powers=get_all_powers())
+    return render_template('home.html', temps=g.fridge.get_all_temps(), powers=g.fridge.get_all_powers())
 
 
 def json_request_handler():
@@ -286,32 +619,25 @@ def json_request_handler():
         return
 
 
-def get_all_temps():
-    temps = {'mxc': db.read_temp(db.mxc_ch),
-             'still': db.read_temp(db.still_ch),
-             'four_k': db.read_temp(db.fourk_ch),
-             'fifty_k': db.read_temp(db.fiftyk_ch)}
-
-    return temps
-
-
-def get_all_powers():
-    powers = {'mxc': db.read_heater(db.mxc_ind),
-              'still': db.read_heater(db.still_ind),
-              'mxc_switch': db.read_heater(db.mxc_switch_ind),
-              'still_switch': db.read_heater(db.still_switch_ind)}
-
-    return powers
-
+def long_poll_timeout(requested):
+    try:
+        return min(max(float(requested), 0), LONG_POLL_MAX_TIMEOUT)
+    except (TypeError, ValueError):
+        return LONG_POLL_TIMEOUT
 
-def exec_tcontrol():
-    tccontrol = XLDTempHandler(database=db, ip=blueftc_ip, update_interval=5)
-    tccontrol.exec()
 
+app.register_blueprint(fridge_bp, url_prefix='/fridge/<fridge>')
+app.register_blueprint(fridge_bp, name='default')
 
 flask_server = Process(target=exec_flask, name='XLD Server')
-tc_process = Process(target=exec_tcontrol, name='Temperature Controller')
 
 if __name__ == "__main__":
+    log_listener = setup_logging()
     flask_server.start()
-    tc_process.start()
+    for fridge in fridges.values():
+        fridge.process.start()
+    flask_server.join()
+    for fridge in fridges.values():
+        fridge.process.join()
+        fridge.snapshot.unlink()
+    log_listener.stop()
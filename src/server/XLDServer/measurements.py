@@ -6,6 +6,9 @@ GO = 'go'
 RUNNING = 'running'
 CRASHED = 'crashed'
 
+# a measurement in a sweep point counts as crashed after this many heartbeat intervals without one
+MISSED_HEARTBEATS = 3
+
 
 @dataclass
 class Measurement:
@@ -0,0 +1,112 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from math import inf
+from threading import Lock
+from time import monotonic, perf_counter
+import json
+import os
+
+# upper bounds in seconds, from sub-millisecond database statements to thermalization phases
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800, 7200)
+
+HELP = {'xld_http_request_seconds': 'Flask route latency.',
+        'xld_db_statement_seconds': 'ServerDB statement time, including waits for the sqlite write lock.',
+        'xld_db_lock_wait_seconds': 'Time ServerDB operations wait for the temperature and heater locks.',
+        'xld_controller_call_seconds': 'Latency of single temperature controller calls.',
+        'xld_controller_cycle_seconds': 'Duration of a full XLDTempHandler update cycle.',
+        'xld_sweep_phase_seconds': 'Duration of temperature sweep phases.'}
+
+FLUSH_INTERVAL = 10
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    # Histograms live in the memory of each process and are flushed to the metrics table of the database,
+    # where the /metrics route sums them over all processes.
+    def __init__(self, flush_interval: float = FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self._reset()
+        # a forked process starts with an empty registry instead of counting its parent's observations twice,
+        # and with a new lock, a request thread of the parent may have held the old one at the fork
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self.lock = Lock()
+        self.pid = os.getpid()
+        self.histograms = {}
+        self.last_flush = -inf
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - start, **labels)
+
+    def flush(self, db, force: bool = False):
+        if not force and monotonic() - self.last_flush < self.flush_interval:
+            return
+
+        with self.lock:
+            rows = [(name, json.dumps(dict(labels)), json.dumps(h.counts), h.sum, h.count)
+                    for (name, labels), h in self.histograms.items()]
+            self.last_flush = monotonic()
+
+        db.write_metrics(process=str(self.pid), rows=rows)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render(rows: list):
+    # rows of (name, labels, bucket counts, sum, count) from all processes, in the Prometheus text format
+    merged = {}
+    for name, labels, counts, total, count in rows:
+        h = merged.setdefault((name, labels), Histogram())
+        h.counts = [a + b for a, b in zip(h.counts, json.loads(counts))]
+        h.sum += total
+        h.count += count
+
+    lines = []
+    for name in sorted({name for name, _ in merged}):
+        lines.append(f'# HELP {name} {HELP.get(name, "")}')
+        lines.append(f'# TYPE {name} histogram')
+        for (metric, labels), h in sorted(merged.items()):
+            if metric != name:
+                continue
+
+            label_str = ','.join(f'{k}="{_escape(v)}"' for k, v in json.loads(labels).items())
+            sep = ',' if label_str else ''
+            cumulative = 0
+            for bound, n in zip(list(BUCKETS) + ['+Inf'], h.counts):
+                cumulative += n
+                lines.append(f'{name}_bucket{{{label_str}{sep}le="{bound}"}} {cumulative}')
+            braces = f'{{{label_str}}}' if label_str else ''
+            lines.append(f'{name}_sum{braces} {h.sum}')
+            lines.append(f'{name}_count{braces} {h.count}')
+
+    return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
@@ -0,0 +1,36 @@
+from multiprocessing import Condition, Value
+from time import monotonic
+
+# upper bound for a single wait, so writers that do not share the notifier are still picked up
+RECHECK_INTERVAL = 2.0
+
+
+class ChangeNotifier:
+    def __init__(self):
+        self._cond = Condition()
+        self._version = Value('Q', 0, lock=False)
+
+    @property
+    def version(self):
+        return self._version.value
+
+    def notify(self):
+        with self._cond:
+            self._version.value += 1
+            self._cond.notify_all()
+
+    def wait(self, version: int, timeout: float):
+        with self._cond:
+            return self._cond.wait_for(lambda: self._version.value != version, timeout)
+
+
+def wait_for_change(notifier: ChangeNotifier, read, done, timeout: float):
+    deadline = monotonic() + timeout
+    while True:
+        version = notifier.version
+        current = read()
+        remaining = deadline - monotonic()
+        if done(current) or remaining <= 0:
+            return current
+
+        notifier.wait(version, min(remaining, RECHECK_INTERVAL))
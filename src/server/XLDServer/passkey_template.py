@@ -4,3 +4,9 @@ db_filename = "YOUR_DATABASE_NAME_HERE.db"
 key = 'YOUR_API_KEY_HERE'
 blueftc_ip = "192.168.1.3"
 xld_ip = '127.0.0.1'
+controller_backend = 'blueftc'  # 'simulated' runs the server without a fridge
+fridges = {'xld': {'ip': blueftc_ip, 'db_filename': db_filename}}  # ip, backend, db_filename, update_interval
+default_fridge = 'xld'  # fridge served by the routes without the /fridge/<name> prefix
+resume_sweeps = True  # continue a sweep interrupted by a server restart after its last finished point
+run_sweep_queue = True  # start queued sweeps as soon as a fridge is idle, False waits until resumed in the web UI
+max_clients = 24  # client processes served at once over all fridges, each holds a server thread while it waits
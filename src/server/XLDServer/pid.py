@@ -0,0 +1,45 @@
+import numpy as np
+
+
+class PIDController:
+    # Errors in mK, output in uW. The derivative acts on the measurement to avoid a kick on setpoint changes,
+    # the integral only accumulates while the output is not saturated.
+    def __init__(self, target: float, kp: float, ki: float, kd: float, max_power: float, initial_power: float = 0.0):
+        self.target = target
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.max_power = max_power
+        self.initial_power = initial_power
+        self.integral = 0.0
+        self.last_temp = None
+        self.last_time = None
+
+    def update(self, temp: float, now: float):
+        error = (self.target - temp) * 1e3
+        dt = 0.0 if self.last_time is None else now - self.last_time
+        derivative = 0.0 if dt <= 0 else -(temp - self.last_temp) * 1e3 / dt
+        self.last_temp, self.last_time = temp, now
+
+        integral = self.integral + error * dt
+        power = self.initial_power + self.kp * error + self.ki * integral + self.kd * derivative
+        if 0 <= power <= self.max_power:
+            self.integral = integral
+
+        return float(np.clip(power, 0, self.max_power))
+
+
+def feed_forward_power(power_map: list, target: float):
+    # steady-state (power, temperature) pairs, the cooling power of the mixing chamber grows with T^2
+    if len(power_map) < 2:
+        return None
+
+    powers, temps = np.array(power_map, dtype=float).T
+    if np.ptp(temps) <= 0:
+        return None
+
+    slope, offset = np.polyfit(np.square(temps), powers, 1)
+    if slope <= 0:
+        return None
+
+    return max(float(slope * target ** 2 + offset), 0.0)
@@ -0,0 +1,62 @@
+from math import inf
+from threading import Lock
+
+from clock import Clock
+
+FLUSH_INTERVAL = 2
+
+
+def eta(progress, progress_time, point_start, now: float):
+    # seconds until a client finishes its current point, extrapolated linearly from its progress since the start
+    if progress is None or progress_time is None or point_start is None:
+        return None
+
+    if progress >= 1:
+        return 0.0
+
+    elapsed = progress_time - point_start
+    if progress <= 0 or elapsed <= 0:
+        return None
+
+    return max(point_start + elapsed / progress - now, 0.0)
+
+
+class ProgressBuffer:
+    # Clients may report progress many times per second. Reports are coalesced per client in memory and written
+    # to the clients table in one transaction at most every flush_interval, readers overlay the unflushed ones.
+    def __init__(self, flush_interval: float = FLUSH_INTERVAL, clock: Clock = Clock()):
+        self.flush_interval = flush_interval
+        self.clock = clock
+        self.lock = Lock()
+        self.pending = {}
+        self.last_flush = -inf
+
+    def report(self, db, progress: dict, timestamp: float = None):
+        timestamp = self.clock.time() if timestamp is None else timestamp
+        with self.lock:
+            self.pending.update({meas_id: (min(max(float(p), 0.0), 1.0), timestamp) for meas_id, p in progress.items()})
+
+        self.flush(db)
+
+    def latest(self):
+        with self.lock:
+            return dict(self.pending)
+
+    def flush(self, db, force: bool = False):
+        if not force and self.clock.monotonic() - self.last_flush < self.flush_interval:
+            return
+
+        with self.lock:
+            rows, self.pending = self.pending, {}
+            self.last_flush = self.clock.monotonic()
+
+        if rows:
+            db.write_meas_progress(rows)
+
+    def flush_meas(self, db, meas_ids: list):
+        # the last reports of clients that stop or deregister are written right away instead of with the next flush
+        with self.lock:
+            rows = {meas_id: self.pending.pop(meas_id) for meas_id in meas_ids if meas_id in self.pending}
+
+        if rows:
+            db.write_meas_progress(rows)
@@ -0,0 +1,61 @@
+import logging
+import threading
+from time import monotonic
+
+xld_logger = logging.getLogger('waitress')
+
+# seconds between checks whether the fridge is idle, adding a job checks right away
+QUEUE_CHECK_INTERVAL = 10
+# how long params generated on the sweep page hold back the queue before they are discarded
+OPERATOR_HOLD = 30 * 60
+
+
+class SweepScheduler:
+    # Thread in the server process that starts the next sweep from the queue of a fridge whenever it is idle
+    # and flushes the buffered progress reports of its clients.
+    def __init__(self, fridge, interval: float = QUEUE_CHECK_INTERVAL):
+        self.fridge = fridge
+        self.interval = interval
+        self.test_mode = False
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self.thread = None
+
+    def start(self, test_mode: bool = False):
+        if self.thread is not None:
+            return
+
+        self.test_mode = test_mode
+        self._stop.clear()
+        self.thread = threading.Thread(target=self._run, name=f'{self.fridge.name} Scheduler', daemon=True)
+        self.thread.start()
+
+    def wake(self):
+        self._wake.set()
+
+    def stop(self):
+        if self.thread is not None:
+            self._stop.set()
+            self._wake.set()
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        next_check = monotonic()
+        while not self._stop.is_set():
+            if self._wake.is_set() or monotonic() >= next_check:
+                # cleared before the check, so jobs added meanwhile are picked up by the next one
+                self._wake.clear()
+                try:
+                    self.fridge.start_queued_sweep(test_mode=self.test_mode)
+                except Exception:
+                    xld_logger.exception(f'TEMPERATURE CONTROL: Sweep scheduler of {self.fridge.name} failed.')
+                next_check = monotonic() + self.interval
+
+            # the last progress reports of clients that went quiet are not left in memory
+            try:
+                self.fridge.progress.flush(self.fridge.db)
+            except Exception:
+                xld_logger.exception(f'DATABASE OPERATION: Progress flush of {self.fridge.name} failed.')
+
+            self._wake.wait(max(min(self.fridge.progress.flush_interval, next_check - monotonic()), 0))
@@ -0,0 +1,69 @@
+from multiprocessing import shared_memory
+from datetime import datetime
+
+import numpy as np
+
+from database_sqlite import to_epoch
+
+SEQ_BYTES = 8
+
+
+class SharedSnapshot:
+    # Single writer (temperature controller process), many readers. Lock-free sequence lock:
+    # the counter is odd while a write is in progress and readers retry until they see the same even value twice.
+    def __init__(self, temp_channels: list, heater_indices: list, name: str = None):
+        self.temp_channels = list(temp_channels)
+        self.heater_indices = list(heater_indices)
+        n_slots = len(self.temp_channels) + len(self.heater_indices)
+
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=SEQ_BYTES + n_slots * 2 * 8)
+            self.shm.buf[:] = bytes(self.shm.size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+
+        self._seq = np.ndarray((1,), dtype=np.uint64, buffer=self.shm.buf)
+        self._data = np.ndarray((n_slots, 2), dtype=np.float64, buffer=self.shm.buf, offset=SEQ_BYTES)
+        self._temp_slots = {ch: k for k, ch in enumerate(self.temp_channels)}
+        self._heater_slots = {i: k + len(self.temp_channels) for k, i in enumerate(self.heater_indices)}
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def publish(self, temps: dict = None, powers: dict = None):
+        temps = temps or {}
+        powers = powers or {}
+        self._seq[0] += 1
+        for ch, (val, timestamp) in temps.items():
+            if ch in self._temp_slots:
+                self._data[self._temp_slots[ch]] = (val, to_epoch(timestamp))
+
+        for i, (val, timestamp) in powers.items():
+            if i in self._heater_slots:
+                self._data[self._heater_slots[i]] = (val, to_epoch(timestamp))
+        self._seq[0] += 1
+
+    def read(self):
+        while True:
+            seq = int(self._seq[0])
+            if seq % 2:
+                continue
+
+            data = self._data.copy()
+            if int(self._seq[0]) == seq:
+                break
+
+        temps = {ch: (float(data[k, 0]), datetime.fromtimestamp(data[k, 1]))
+                 for ch, k in self._temp_slots.items() if data[k, 1] > 0}
+        powers = {i: (float(data[k, 0]), datetime.fromtimestamp(data[k, 1]))
+                  for i, k in self._heater_slots.items() if data[k, 1] > 0}
+
+        return seq, temps, powers
+
+    def close(self):
+        del self._seq, self._data
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
@@ -1,44 +1,174 @@
-from blueftc.BlueFTController import BlueFTController
+from clock import Clock
+from controllers import make_controller
 from database_sqlite import ServerDB
+from metrics import metrics
+from notifier import RECHECK_INTERVAL
+from pid import PIDController, feed_forward_power
+from snapshot import SharedSnapshot
 
-from time import sleep
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Event
 from numpy import isclose
+from threading import Lock, Thread
 import logging
 
 xld_logger = logging.getLogger('waitress')
 
 
 class XLDTempHandler:
-    def __init__(self, database: ServerDB, ip: str, update_interval: int):
+    def __init__(self, database: ServerDB, ip: str, update_interval: int, rate_window: int = 12,
+                 snapshot: SharedSnapshot = None, controller=None, clock: Clock = Clock(),
+                 reconcile_interval: float = 60):
         self.db = database
-        self.controller = BlueFTController(ip)
+        self.snapshot = snapshot
+        self.clock = clock
+        self.controller = controller if controller is not None else make_controller('blueftc', ip)
         self.update_interval = update_interval
+        # full controller/database heater diff as a safety net, commands are pushed when written
+        self.reconcile_interval = reconcile_interval
+        self.last_reconcile = None
+        self.publish_lock = Lock()
+        # the cycle and the push thread both send heater commands, in the order the rows were popped
+        self.push_lock = Lock()
         self.temp_channels = list(self.controller.channels.keys())
         self.heater_indices = list(self.controller.heaters.keys())
         self.first_exec = True
+        self.pool = ThreadPoolExecutor(max_workers=len(self.temp_channels) + len(self.heater_indices),
+                                       thread_name_prefix='Controller Read')
+        self.cycle_starts = deque(maxlen=rate_window)
+        self.pid = None
+        self.pid_key = None
+        self.achieved_rate = 0.0
 
-    def _update_temps(self):
-        for ch in self.temp_channels:
-            temp = self.controller.get_latest_channel_temp(ch)
-            self.db.write_temp(channel=ch, val=temp[0], timestamp=temp[1])
+    def _call_controller(self, method: str, *args, **kwargs):
+        with metrics.timer('xld_controller_call_seconds', call=method):
+            return getattr(self.controller, method)(*args, **kwargs)
 
-    def _update_heaters(self):
+    def _read_controller(self, read_heaters: bool = True):
+        temp_futures = [self.pool.submit(self._call_controller, 'get_latest_channel_temp', ch)
+                        for ch in self.temp_channels]
+        heater_futures = [self.pool.submit(self._call_controller, 'get_heater_power', i)
+                          for i in self.heater_indices] if read_heaters else []
+
+        return [f.result() for f in temp_futures], [f.result() for f in heater_futures]
+
+    def _update_temps(self, temps: list):
+        readings = [(ch, temp[0], temp[1]) for ch, temp in zip(self.temp_channels, temps)]
+        self.db.write_temps(readings)
+
+    def _update_heaters(self, powers: list):
         if self.first_exec:
-            [self.db.write_heater(i, self.controller.get_heater_power(i)) for i in self.heater_indices]
+            for i, actual_pow in zip(self.heater_indices, powers):
+                self.db.write_heater(i, actual_pow, self.clock.now(), dirty=False)
             self.first_exec = False
 
-        for i in self.heater_indices:
-            actual_pow = self.controller.get_heater_power(i)
-            db_pow = self.db.read_heater(index=i)
+        for i, actual_pow in zip(self.heater_indices, powers):
+            if isclose(actual_pow, self.db.read_heater(index=i)):
+                continue
+
+            # the push thread may have applied a command since the read at the start of the cycle
+            with self.push_lock:
+                actual_pow = self._call_controller('get_heater_power', i)
+                db_pow = self.db.read_heater(index=i)
+                if not isclose(actual_pow, db_pow):
+                    xld_logger.warning(f"TEMPERATURE CONTROL: Heater {i} at {actual_pow} uW instead of {db_pow} uW. "
+                                       f"Reapplying.")
+                    self._call_controller('set_heater_power', heater_nr=i, setpower=db_pow)
+
+    def push_heaters(self):
+        pushed = {}
+        with self.push_lock:
+            for i, power in self.db.pop_dirty_heaters():
+                if i in self.heater_indices:
+                    self._call_controller('set_heater_power', heater_nr=i, setpower=power)
+                    pushed[i] = (power, self.clock.now())
+
+            if pushed:
+                self._publish_snapshot(powers=pushed)
+
+        return pushed
+
+    def _push_loop(self, stop: Event):
+        while not stop.is_set():
+            version = self.db.heater_notifier.version
+            try:
+                self.push_heaters()
+            except Exception as ex:
+                xld_logger.warning(f"TEMPERATURE CONTROL: Pushing heater commands failed: {ex}")
+            self.db.heater_notifier.wait(version, RECHECK_INTERVAL)
+
+    def _update_setpoint(self, temps: list):
+        # server-side PID towards the setpoint written by a PID sweep, the output goes through the heaters table
+        setpoint = self.db.read_setpoint(index=self.db.mxc_ind)
+        if setpoint is None or setpoint['channel'] not in self.temp_channels:
+            self.pid = self.pid_key = None
+            return
+
+        key = (setpoint['target'], setpoint['tstamp'])
+        if key != self.pid_key:
+            initial = feed_forward_power(self.db.read_power_map(), setpoint['target'])
+            if initial is None:
+                initial = self.db.read_heater(index=self.db.mxc_ind)
+            self.pid = PIDController(setpoint['target'], setpoint['kp'], setpoint['ki'], setpoint['kd'],
+                                     setpoint['max_power'], initial_power=min(initial, setpoint['max_power']))
+            self.pid_key = key
+            xld_logger.info(f"TEMPERATURE CONTROL: PID towards {setpoint['target']} K, starting from {initial:.2f} uW.")
+
+        temp = temps[self.temp_channels.index(setpoint['channel'])][0]
+        power = self.pid.update(temp, self.clock.time())
+        self.db.write_heater(index=self.db.mxc_ind, val=power, timestamp=self.clock.now())
+
+    def _publish_snapshot(self, temps: dict = None, powers: dict = None):
+        # the cycle and the push thread both publish, the snapshot allows a single writer at a time
+        if self.snapshot is not None:
+            with self.publish_lock:
+                self.snapshot.publish(temps=temps, powers=powers)
+
+    def _update_rate(self, cycle_start: float):
+        self.cycle_starts.append(cycle_start)
+        if len(self.cycle_starts) > 1:
+            self.achieved_rate = (len(self.cycle_starts) - 1) / (self.cycle_starts[-1] - self.cycle_starts[0])
+
+    def cycle(self):
+        cycle_start = self.clock.monotonic()
+        self._update_rate(cycle_start)
+
+        reconcile = self.last_reconcile is None or cycle_start - self.last_reconcile >= self.reconcile_interval
+        temps, powers = self._read_controller(read_heaters=reconcile)
+        now = self.clock.now()
+        self._publish_snapshot(temps={ch: (temp[0], temp[1]) for ch, temp in zip(self.temp_channels, temps)},
+                               powers={i: (p, now) for i, p in zip(self.heater_indices, powers)})
+        self._update_temps(temps)
+        if reconcile:
+            self._update_heaters(powers)
+            self.last_reconcile = cycle_start
+        self._update_setpoint(temps)
+        self.push_heaters()
+
+        cycle_time = self.clock.monotonic() - cycle_start
+        metrics.observe('xld_controller_cycle_seconds', cycle_time)
+        metrics.flush(self.db)
+        xld_logger.info(f"Temperatures and heater power updated in {cycle_time:.3f} s. "
+                        f"Sample rate: {self.achieved_rate:.3f} Hz (target {1 / self.update_interval:.3f} Hz).",
+                        extra={'aggregate': 'temperature updates'})
+
+        return cycle_time
 
-            if not isclose(actual_pow, db_pow):
-                self.controller.set_heater_power(heater_nr=i, setpower=db_pow)
+    def exec(self, stop: Event = None):
+        stop = stop if stop is not None else Event()
+        Thread(target=self._push_loop, args=(stop,), name='Heater Commands', daemon=True).start()
 
-    def exec(self):
-        while True:
-            self._update_temps()
-            self._update_heaters()
-            xld_logger.info("Temperatures and heater power updated.")
-            sleep(self.update_interval)
+        next_cycle = self.clock.monotonic()
+        while not stop.is_set():
+            cycle_time = self.cycle()
+            now = self.clock.monotonic()
 
+            # fixed rate: schedule against the previous deadline, not the end of this cycle
+            next_cycle += self.update_interval
+            if next_cycle < now:
+                missed = int((now - next_cycle) // self.update_interval) + 1
+                next_cycle += missed * self.update_interval
+                xld_logger.warning(f"Temperature update took {cycle_time:.3f} s, skipped {missed} cycle(s).")
 
+            self.clock.wait(stop, next_cycle - now)
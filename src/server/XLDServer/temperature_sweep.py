@@ -1,95 +1,255 @@
+import secrets
 import sys
+from contextlib import contextmanager
+from time import monotonic
 
-from src.server.XLDServer.database_sqlite import ServerDB
-from passkey import db_filename
+from clock import Clock
+from database_sqlite import ServerDB
+from measurements import GO, RUNNING
+from metrics import metrics
+from notifier import ChangeNotifier, RECHECK_INTERVAL
 
 import numpy as np
-from time import sleep
-from datetime import datetime
-from multiprocessing import Event
+from multiprocessing import Event, Process
 import logging
 
 xld_logger = logging.getLogger('waitress')
 
+# adaptive thermalization: fit over the last SETTLE_WINDOW seconds of mixing chamber readings
+SETTLE_WINDOW = 300
+SETTLE_CHECK_INTERVAL = 10
+SETTLE_MIN_SAMPLES = 5
+
 
 class TemperatureSweep:
     def __init__(self, thermalization_time, power_array, client_timeout, return_to_base: bool = False,
                  abort_flag: Event = Event(), is_running: Event = Event(), test_mode: bool = False,
-                 skip_first: bool = False):
+                 skip_first: bool = False, database: ServerDB = None, clock: Clock = Clock(),
+                 settle_tolerance: float = None, min_thermalization_time: float = 0,
+                 settle_window: float = SETTLE_WINDOW, setpoints=None, pid_gains: tuple = (1, 1, 1),
+                 max_power: float = 1000, sweep_id: str = None, params: dict = None, start_point: int = 0,
+                 client_group: str = None):
         self.thermalization_time = float(thermalization_time)
         self.power_array = np.array(power_array)
-        self.db = ServerDB(db_filename)
+        # PID mode: mixing chamber setpoints in K instead of heater powers, held by the temperature controller
+        self.setpoints = None if setpoints is None else np.array(setpoints, dtype=float)
+        self.pid_gains = tuple(float(g) for g in pid_gains)
+        self.max_power = float(max_power)
+        self._target = None
+        # names the rows of this sweep in sweeps and sweep_points, defaults to its creation time and a random
+        # suffix, a reused id would continue the progress and overwrite the points of the earlier sweep
+        self.sweep_id = (sweep_id if sweep_id is not None else
+                         f"{clock.now().strftime('%Y%m%d-%H%M%S-%f')}-{secrets.token_hex(2)}")
+        # the TemperatureSweepManager params it was generated from, stored to resume it after a restart
+        self.params = params
+        self.start_point = int(start_point)
+        # only the clients of this group get GO signals and are waited for, None for all clients
+        self.client_group = client_group
+        self.db = database if database is not None else ServerDB()
         self.client_timeout = float(client_timeout)
         self.test_mode = float(test_mode)
         self.abort_flag = abort_flag
         self.is_running = is_running
         self.return_to_base = return_to_base
         self.skip_first = skip_first
+        self.clock = clock
+        # relative drift and noise allowed over the settle window, None waits the full thermalization_time
+        self.settle_tolerance = None if settle_tolerance is None else float(settle_tolerance)
+        self.min_thermalization_time = float(min_thermalization_time)
+        self.settle_window = float(settle_window)
+
+    def _clients_done(self):
+        for signal, crashed in self.db.get_all_meas_signals(group=self.client_group):
+            if signal in (RUNNING, GO) and not crashed:
+                return False
+
+        return True
 
     def wait_for_all_clients(self):
-        start = datetime.now()
-        done = False
-        while not done:
+        start = self.clock.monotonic()
+        while True:
+            version = self.db.meas_notifier.version
             self._try_abort()
-            done = True
-            for signal, crashed in self.db.get_all_meas_signals():
-                if signal == 'running' or signal == 'go' and not crashed:
-                    done = False
+            self.db.mark_silent_meas_as_crashed(group=self.client_group, timestamp=self.clock.now())
+            if self._clients_done():
+                return
 
-            if (datetime.now() - start).total_seconds() >= self.client_timeout:
+            remaining = self.client_timeout - (self.clock.monotonic() - start)
+            if remaining <= 0:
                 clients = self.db.get_html_meas_dict()
                 for meas in clients:
-                    if meas['signal'] == 'running' or meas['signal'] == 'go':
+                    if self.client_group is not None and meas['group'] != self.client_group:
+                        continue
+                    if meas['signal'] == RUNNING or meas['signal'] == GO:
                         self.db.set_meas_as_crashed(meas_id=meas['id'])
-                done = True
+                return
+
+            # woken by client status changes and aborts, rechecks periodically as a fallback
+            self.clock.wait_change(self.db.meas_notifier, version, min(remaining, RECHECK_INTERVAL))
 
-            sleep(5)
+    def _wait(self, seconds: float):
+        self.clock.wait(self.abort_flag, seconds)
+        self._try_abort()
+
+    def _settled(self, since: float):
+        now = self.clock.time()
+        start = max(now - self.settle_window, since)
+        history = np.array(self.db.read_temp_history(channel=self.db.mxc_ch, start=start, end=now))
+        if now - start < self.settle_window or len(history) < SETTLE_MIN_SAMPLES:
+            return False
+
+        t, temp = history[:, 0] - history[0, 0], history[:, 1]
+        slope, offset = np.polyfit(t, temp, 1)
+        mean = np.mean(temp)
+        drift = abs(slope) * self.settle_window / mean
+        noise = np.std(temp - (slope * t + offset)) / mean
+        offset_from_target = 0 if not self._target else abs(mean - self._target) / self._target
+
+        return max(drift, noise, offset_from_target) < self.settle_tolerance
+
+    def _thermalize(self):
+        if self.settle_tolerance is None:
+            self._wait(self.thermalization_time)
+            return True
+
+        start = self.clock.time()
+        # settling is judged over a full settle window, so it is also the shortest wait
+        self._wait(min(max(self.min_thermalization_time, self.settle_window), self.thermalization_time))
+        while True:
+            elapsed = self.clock.time() - start
+            if self._settled(since=start):
+                xld_logger.info(f'TEMPERATURE CONTROL: Mixing chamber settled after {elapsed:.0f} s.')
+                return True
+
+            if elapsed >= self.thermalization_time:
+                xld_logger.warning(f'TEMPERATURE CONTROL: Mixing chamber not settled within the maximum '
+                                   f'thermalization time of {self.thermalization_time:.0f} s. Continuing.')
+                return False
+
+            self._wait(min(SETTLE_CHECK_INTERVAL, self.thermalization_time - elapsed))
+
+    @contextmanager
+    def _phase(self, name: str):
+        start = self.clock.monotonic()
+        try:
+            yield
+        finally:
+            metrics.observe('xld_sweep_phase_seconds', self.clock.monotonic() - start, phase=name)
+            metrics.flush(self.db, force=True)
+
+    def _set_point(self, value: float):
+        if self.setpoints is None:
+            self.db.write_heater(index=self.db.mxc_ind, val=float(value), timestamp=self.clock.now())
+            xld_logger.info(f'TEMPERATURE CONTROL: Set heater power to {value} uW.')
+
+        elif value <= 0:
+            self._target = None
+            self.db.clear_setpoint(index=self.db.mxc_ind)
+            self.db.write_heater(index=self.db.mxc_ind, val=0.0, timestamp=self.clock.now())
+            xld_logger.info(f'TEMPERATURE CONTROL: Heater off for base temperature.')
+
+        else:
+            self._target = float(value)
+            self.db.write_setpoint(self.db.mxc_ind, self.db.mxc_ch, self._target, *self.pid_gains,
+                                   max_power=self.max_power, timestamp=self.clock.now())
+            xld_logger.info(f'TEMPERATURE CONTROL: Set mixing chamber setpoint to {value * 1e3:.1f} mK.')
+
+    def _thermalize_point(self):
+        with self._phase('thermalization'):
+            settled = self._thermalize()
+
+        # steady-state points feed the feed-forward of PID sweeps
+        if settled:
+            self.db.write_power_map(power=self.db.read_heater(index=self.db.mxc_ind),
+                                    temp=self.db.read_temp(channel=self.db.mxc_ch), timestamp=self.clock.now())
 
     def start_all_client_meas(self):
-        self.db.set_all_meas_to_go()
+        self.db.set_all_meas_to_go(group=self.client_group)
 
     def exec(self):
+        state = None
+        try:
+            self._exec()
+            state = 'finished'
+        except SystemExit:
+            state = 'aborted'
+            raise
+        except Exception:
+            state = 'failed'
+            raise
+        finally:
+            # also on aborts, the last PID output stays on the heater
+            if self.setpoints is not None and not self.test_mode:
+                self.db.clear_setpoint(index=self.db.mxc_ind)
+            # killed or interrupted sweeps stay running and are resumed on the next server start
+            if state is not None:
+                self.db.set_sweep_state(self.sweep_id, state, timestamp=self.clock.now())
+
+    def _exec(self):
         self.is_running.set()
+        points = self.power_array if self.setpoints is None else self.setpoints
+        self.db.write_sweep(self.sweep_id, params=self.params, n_points=len(points), timestamp=self.clock.now())
         xld_logger.info(f'TEMPERATURE CONTROL: Making sure that all clients are ready.')
-        self.wait_for_all_clients()
-        xld_logger.info(f'TEMPERATURE CONTROL: Started sweep.')
+        with self._phase('clients_ready'):
+            self.wait_for_all_clients()
+        if self.start_point < len(points) and self.db.sweep_point_started(self.sweep_id, self.start_point):
+            # clients got GO for it before the interruption and count it as measured, repeating it would shift
+            # their point counters, the wait above was the rest of its measurement
+            self.db.finish_sweep_point(self.sweep_id, self.start_point, done_time=self.clock.now())
+            xld_logger.info(f'TEMPERATURE CONTROL: Finished interrupted point {self.start_point + 1}/{len(points)}.')
+            self.start_point += 1
+        if self.start_point:
+            xld_logger.info(f'TEMPERATURE CONTROL: Resumed sweep {self.sweep_id} at point '
+                            f'{self.start_point + 1}/{len(points)}.')
+        else:
+            xld_logger.info(f'TEMPERATURE CONTROL: Started sweep {self.sweep_id}.')
 
-        for i, power in enumerate(self.power_array):
+        for i, point in enumerate(points):
+            if i < self.start_point:
+                continue
             self._try_abort()
             if not self.test_mode:
-                self.db.write_heater(index=self.db.mxc_ind, val=float(power))
-            xld_logger.info(f'TEMPERATURE CONTROL: Set heater power to {power} uW.')
+                self._set_point(point)
             if i == 0:
                 if not self.skip_first:
                     xld_logger.info(f'TEMPERATURE CONTROL: Waiting {self.thermalization_time} s for thermalization.')
                     if not self.test_mode:
-                        sleep(self.thermalization_time)
+                        self._thermalize_point()
                 else:
                     xld_logger.info(f'TEMPERATURE CONTROL: Skipping first thermalization.')
             else:
                 xld_logger.info(f'TEMPERATURE CONTROL: Waiting {self.thermalization_time} s for thermalization.')
                 if not self.test_mode:
-                    sleep(self.thermalization_time)
+                    self._thermalize_point()
             self._try_abort()
             xld_logger.info(
                 f'TEMPERATURE CONTROL: Thermalization done. Current temperature at mixing chamber: '
                 f'{self.db.read_temp(channel=self.db.mxc_ch)} K')
             self.start_all_client_meas()
+            self.db.write_sweep_point(self.sweep_id, i, mode='direct-power' if self.setpoints is None else 'pid',
+                                      target=float(point), power=self.db.read_heater(index=self.db.mxc_ind),
+                                      temp=self.db.read_temp(channel=self.db.mxc_ch), go_time=self.clock.now())
             xld_logger.info(f'TEMPERATURE CONTROL: Send GO signal to all measurement clients.')
             if not self.test_mode:
-                sleep(30)
+                with self._phase('go_delay'):
+                    self._wait(30)
             self._try_abort()
             xld_logger.info(
                 f'TEMPERATURE CONTROL: Waiting for all measurements to finish at current '
-                f'temperature point ({i + 1}/{len(self.power_array)}).')
-            self.wait_for_all_clients()
+                f'temperature point ({i + 1}/{len(points)}).')
+            with self._phase('measurement'):
+                self.wait_for_all_clients()
+            self.db.finish_sweep_point(self.sweep_id, i, done_time=self.clock.now())
             xld_logger.info(f'TEMPERATURE CONTROL: All measurements finished at current temperature point.')
             self._try_abort()
 
+        if self.setpoints is not None and not self.test_mode:
+            self.db.clear_setpoint(index=self.db.mxc_ind)
+
         if self.return_to_base:
             xld_logger.info(f'TEMPERATURE CONTROL: Returning to base temperature.')
             if not self.test_mode:
-                self.db.write_heater(index=self.db.mxc_ind, val=0.0)
+                self.db.write_heater(index=self.db.mxc_ind, val=0.0, timestamp=self.clock.now())
 
         else:
             xld_logger.info(f'TEMPERATURE CONTROL: Not returning to base temperature.')
@@ -111,6 +271,29 @@ class TemperatureSweep:
             return False
 
 
+class SweepExecutor:
+    def __init__(self, name: str = 'Temperature Sweep'):
+        self.name = name
+        self.process = None
+
+    @property
+    def busy(self):
+        return self.process is not None and self.process.is_alive()
+
+    def start(self, sweep: TemperatureSweep):
+        if self.busy:
+            return False
+
+        if self.process is not None:
+            self.process.join()
+
+        self.process = Process(target=sweep.exec, name=self.name, daemon=True)
+        self.process.start()
+        xld_logger.info(f'TEMPERATURE CONTROL: Sweep executor started (pid {self.process.pid}).')
+
+        return True
+
+
 class TemperatureSweepManager:
     def __init__(self):
         self.modes = ['pid', 'direct-power']
@@ -124,10 +307,18 @@ class TemperatureSweepManager:
         self.html_dict = {}
         self.return_to_base = False
         self.skip_first = False
+        self.adaptive = False
+        self.settle_tol = 0
+        self.min_therm_time = 0
+        self.pid_gains = (0, 0, 0)
+        self.pid_max_pow = 0
+        self.client_group = None
+        self.generated_at = None
         self.params = {}
         self.confirmed = False
         self.started = False
         self.client_dict = {}
+        self.changed = ChangeNotifier()
 
         self.generate_html_dict()
 
@@ -143,14 +334,14 @@ class TemperatureSweepManager:
         self.cl_timeout = params['client_timeout']
         self.return_to_base = bool(params['ret_base'])
         self.skip_first = bool(params['skip_first'])
+        self.client_group = params.get('client_group') or None
 
         assert sweep_mode in self.modes, "Wrong sweep mode."
         assert interpolation in self.interpolations, "Wrong interpolation."
         if sweep_mode == 'pid':
             assert interpolation in ['linear', 'manual'], "Wrong interpolation for PID mode."
 
-        if sweep_mode == 'direct-power':
-            assert 'therm_time' in params.keys()
+        assert 'therm_time' in params.keys()
 
         if sweep_mode == 'direct-power' and interpolation in ['linear', 'quadratic']:
             assert 'min_pow' in params.keys()
@@ -158,16 +349,43 @@ class TemperatureSweepManager:
             assert 'n_pow' in params.keys()
 
         if sweep_mode == 'pid':
-            raise NotImplementedError
+            assert 'p' in params.keys() and 'i' in params.keys() and 'd' in params.keys()
+            assert 'pid_max_pow' in params.keys()
+
+        if sweep_mode == 'pid' and interpolation == 'linear':
+            assert 'min_temp' in params.keys()
+            assert 'max_temp' in params.keys()
+            assert 'n_temp' in params.keys()
 
         self.params = params
         self.mode = sweep_mode
         self.interpolation = interpolation
 
-        if self.mode == 'direct-power':
-            assert 'therm_time' in self.params.keys()
-            self.therm_time = self.params['therm_time']
+        self.therm_time = self.params['therm_time']
+        self.adaptive = bool(self.params.get('adaptive', False))
+        if self.adaptive:
+            assert 'settle_tol' in self.params.keys() and 'min_therm_time' in self.params.keys()
+            self.settle_tol = float(self.params['settle_tol'])
+            self.min_therm_time = float(self.params['min_therm_time'])
+            assert 0 < self.settle_tol, "Settling tolerance must be positive."
+            assert self.min_therm_time <= float(self.therm_time), "Minimum exceeds thermalization time."
+
+        if self.mode == 'pid':
+            self.pid_gains = (float(self.params['p']), float(self.params['i']), float(self.params['d']))
+            self.pid_max_pow = float(self.params['pid_max_pow'])
+            assert self.pid_max_pow > 0, "Maximum heater power must be positive."
+
+            # setpoints in mK, 0 for base temperature
+            if self.interpolation == 'linear':
+                self.sweep_array = np.linspace(float(self.params['min_temp']), float(self.params['max_temp']),
+                                               int(self.params['n_temp']))
+
+            elif self.interpolation == 'manual':
+                lines = self.params['values'].split('\n')
+                lines = [float(i) for i in lines]
+                self.sweep_array = np.array(lines)
 
+        if self.mode == 'direct-power':
             if self.interpolation == 'linear':
                 self.sweep_array = np.linspace(float(self.params['min_pow']), float(self.params['max_pow']),
                                                int(self.params['n_pow']))
@@ -182,6 +400,7 @@ class TemperatureSweepManager:
                 lines = [float(i) for i in lines]
                 self.sweep_array = np.array(lines)
 
+        self.generated_at = monotonic()
         self.generate_html_dict()
 
     def generate_html_dict(self):
@@ -190,10 +409,19 @@ class TemperatureSweepManager:
         skip = 'SKIP' if self.skip_first else 'NOT SKIP'
         html_dict = {'sweep_mode': self.mode, 'interpolation': self.interpolation,
                      'vals': [f' {v:.0f}' for v in self.sweep_array],
-                     'cl_timeout': self.cl_timeout, 'ret_base': ret, 'skip_first': skip}
+                     'cl_timeout': self.cl_timeout, 'ret_base': ret, 'skip_first': skip,
+                     'client_group': self.client_group or 'all'}
+
+        if self.mode == 'pid':
+            html_dict['pid'] = (f'P = {self.pid_gains[0]} uW/mK, I = {self.pid_gains[1]} uW/(mK s), '
+                                f'D = {self.pid_gains[2]} uW s/mK, at most {self.pid_max_pow} uW')
 
-        if self.mode == 'direct-power' or self.mode == '':
+        if self.mode in ['direct-power', 'pid', '']:
             html_dict['therm_time'] = self.therm_time
+            # the sweep waits at least one settle window, whatever the minimum
+            min_wait = min(max(self.min_therm_time, SETTLE_WINDOW / 60), float(self.therm_time or 0))
+            html_dict['adaptive'] = (f'ends early once settled within {self.settle_tol} %, '
+                                     f'after at least {min_wait:g} minutes') if self.adaptive else 'fixed'
 
         self.html_dict = html_dict
 
@@ -201,16 +429,18 @@ class TemperatureSweepManager:
         assert not self.confirmed
         self.confirmed = True
         self.client_dict = {'abort_in_progress': False, 'confirmed': True, 'sweep_points': len(self.sweep_array),
-                            'client_timeout': self.cl_timeout}
+                            'client_timeout': self.cl_timeout, 'client_group': self.client_group}
         xld_logger.info("TEMPERATURE CONTROL: Parameters set to broadcasted.")
+        self.changed.notify()
 
     def start_sweep(self):
         assert not self.started and self.confirmed
         self.started = True
         self.client_dict = {'abort_in_progress': False, 'sweep_started': True, 'confirmed': True,
                             'sweep_points': len(self.sweep_array),
-                            'client_timeout': self.cl_timeout}
+                            'client_timeout': self.cl_timeout, 'client_group': self.client_group}
         xld_logger.info("TEMPERATURE CONTROL: Sweep set to started.")
+        self.changed.notify()
 
     def clear(self):
         self.mode = ''
@@ -220,9 +450,17 @@ class TemperatureSweepManager:
         self.sweep_array = np.zeros(1)
         self.html_dict = {}
         self.return_to_base = False
+        self.adaptive = False
+        self.settle_tol = 0
+        self.min_therm_time = 0
+        self.pid_gains = (0, 0, 0)
+        self.pid_max_pow = 0
+        self.client_group = None
+        self.generated_at = None
         self.params = {}
         self.confirmed = False
         self.started = False
         self.client_dict = {}
 
         self.generate_html_dict()
+        self.changed.notify()
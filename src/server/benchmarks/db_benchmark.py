@@ -0,0 +1,85 @@
+# Micro-benchmark of the ServerDB temp/heater/client operations.
+# Compares the pooled WAL connections against opening a new connection per statement.
+# Run from src/server with a passkey.py available on the path, e.g.:
+#   python benchmarks/db_benchmark.py -n 2000
+import argparse
+import os
+import sys
+import tempfile
+from contextlib import contextmanager
+import sqlite3 as sq
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'XLDServer'))
+
+from database_sqlite import ServerDB
+
+
+class ConnectPerStatementDB(ServerDB):
+    # the connection handling before pooling, for single statements and transactions alike
+    def _exec_db_command(self, cmd: str, params: tuple = ()):
+        with sq.connect(self.db_name) as con:
+            return con.execute(cmd, params)
+
+    @contextmanager
+    def _transaction(self):
+        con = sq.connect(self.db_name)
+        try:
+            with con:
+                yield con
+        finally:
+            con.close()
+
+
+def bench_temps(db: ServerDB, n: int):
+    for i in range(n):
+        db.write_temp(channel=db.mxc_ch, val=0.01 + i * 1e-6)
+        db.read_temp(channel=db.mxc_ch)
+
+
+def bench_heaters(db: ServerDB, n: int):
+    for i in range(n):
+        db.write_heater(index=db.mxc_ind, val=float(i))
+        db.read_heater(index=db.mxc_ind)
+
+
+def bench_clients(db: ServerDB, n: int):
+    for _ in range(n):
+        meas_id = db.register_measurement(user='bench', group='bench')
+        db.set_meas_status(meas_id=meas_id, status=True)
+        db.get_meas_signal(meas_id)
+        db.set_meas_status(meas_id=meas_id, status=False)
+        db.deregister_measurement(meas_id=meas_id)
+
+
+BENCHMARKS = {'temps (write + read)': bench_temps,
+              'heaters (write + read)': bench_heaters,
+              'clients (register ... deregister)': bench_clients}
+
+
+def run(db_cls, n: int):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        db = db_cls(db_name=os.path.join(tmp, 'bench.db'))
+        db.prep_tables()
+        for name, func in BENCHMARKS.items():
+            start = perf_counter()
+            func(db, n)
+            results[name] = n / (perf_counter() - start)
+        if hasattr(db, 'close'):
+            db.close()
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=1000, help='iterations per operation')
+    args = parser.parse_args()
+
+    before = run(ConnectPerStatementDB, args.n)
+    after = run(ServerDB, args.n)
+
+    print(f"{'operation':<36}{'before (ops/s)':>16}{'after (ops/s)':>16}{'speedup':>10}")
+    for name in BENCHMARKS:
+        print(f"{name:<36}{before[name]:>16.0f}{after[name]:>16.0f}{after[name] / before[name]:>9.1f}x")
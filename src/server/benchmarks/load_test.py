@@ -0,0 +1,209 @@
+# Load test: runs the XLD server in-process with the simulated controller and drives a fleet of
+# simulated XLDMeasClients through register -> listen -> started/stopped -> deregister for a whole sweep.
+# Reports request latency percentiles, coordination overhead per sweep point and time spent in the database.
+#   python benchmarks/load_test.py --clients 100 --points 10
+import argparse
+import os
+import socket
+import sys
+import tempfile
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from time import perf_counter, sleep
+
+import numpy as np
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_DIR = os.path.join(BENCH_DIR, '..', 'XLDServer')
+CLIENT_DIR = os.path.join(BENCH_DIR, '..', '..', 'client')
+
+PASSKEY = """users = {{'admin': {{'password': 'load-test'}}}}
+data_dir = {data_dir!r}
+db_filename = 'load_test.db'
+key = 'load-test'
+blueftc_ip = '127.0.0.1'
+xld_ip = '127.0.0.1'
+max_clients = {max_clients}
+"""
+
+
+class Timings:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = defaultdict(list)
+
+    def add(self, name: str, seconds: float):
+        with self.lock:
+            self.samples[name].append(seconds)
+
+    def report(self, title: str):
+        print(f"\n{title}")
+        print(f"{'':<36}{'n':>8}{'p50 (ms)':>12}{'p90 (ms)':>12}{'p99 (ms)':>12}{'max (ms)':>12}")
+        for name, values in sorted(self.samples.items()):
+            p50, p90, p99 = np.percentile(values, [50, 90, 99]) * 1e3
+            print(f"{name:<36}{len(values):>8}{p50:>12.2f}{p90:>12.2f}{p99:>12.2f}{max(values) * 1e3:>12.2f}")
+
+
+def setup_server(tmp: str, max_clients: int):
+    with open(os.path.join(tmp, 'passkey.py'), 'w') as f:
+        f.write(PASSKEY.format(data_dir=tmp, max_clients=max_clients))
+    sys.path[:0] = [tmp, SERVER_DIR, CLIENT_DIR]
+
+    import main as server
+    server.app.config['SWEEP_TEST_MODE'] = True
+
+    return server
+
+
+def instrument_db(server, timings: Timings):
+    # wall time of every database call in the flask process, including waits for sqlite locks, transactions
+    # (batch registrations, temperature, progress and checkpoint writes) and waits for the ServerDB locks
+    db_cls = type(server.default_fridge.db)
+    exec_db_command, transaction, locked = db_cls._exec_db_command, db_cls._transaction, db_cls._locked
+
+    def timed(self, cmd, params=()):
+        start = perf_counter()
+        try:
+            return exec_db_command(self, cmd, params)
+        finally:
+            timings.add('db: ' + cmd.split()[0].upper(), perf_counter() - start)
+
+    @contextmanager
+    def timed_transaction(self):
+        start = perf_counter()
+        try:
+            with transaction(self) as con:
+                yield con
+        finally:
+            timings.add('db: TRANSACTION', perf_counter() - start)
+
+    @contextmanager
+    def timed_locked(self, lock, name: str):
+        start = perf_counter()
+        with locked(self, lock, name):
+            timings.add(f'db lock wait: {name}', perf_counter() - start)
+            yield
+
+    db_cls._exec_db_command = timed
+    db_cls._transaction = timed_transaction
+    db_cls._locked = timed_locked
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def run_client(client, timings: Timings, events: dict, meas_time: float):
+    request = client._generic_request
+
+    def timed(path, payload=None, timeout=None, idempotent=True):
+        start = perf_counter()
+        try:
+            return request(path, payload=payload, timeout=timeout, idempotent=idempotent)
+        finally:
+            timings.add(path.split(client.http_ip_port, 1)[1].split('?')[0], perf_counter() - start)
+
+    client._generic_request = timed
+    n_sweep, _ = client.open_session()
+    for i in range(n_sweep):
+        client.listen()
+        events['go'][i].append(perf_counter())
+        sleep(meas_time)
+        events['done'][i].append(perf_counter())
+        client.stopped()
+    client.close_session()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=50, help='number of simulated measurement clients (10-500)')
+    parser.add_argument('--points', type=int, default=10, help='number of sweep points')
+    parser.add_argument('--meas-time', type=float, default=0.5, help='simulated measurement duration per point (s)')
+    parser.add_argument('--group-size', type=int, default=1,
+                        help='measurements per client, registered and updated through the batch API if above 1')
+    parser.add_argument('--no-long-poll', action='store_true', help='clients poll instead of long-polling')
+    parser.add_argument('--update-interval', type=float, default=1, help='client polling interval (s)')
+    parser.add_argument('--controller-latency', type=float, default=0.05, help='simulated controller latency (s)')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='server worker threads, defaults to the server setting for one per client plus headroom')
+    args = parser.parse_args()
+
+    from waitress import create_server
+
+    with tempfile.TemporaryDirectory() as tmp:
+        server = setup_server(tmp, max_clients=args.clients)
+        fridge = server.default_fridge
+        from XLDClient.main import XLDMeasClient, XLDMeasClientGroup
+        from controllers import SimulatedController
+        from tempcomm import XLDTempHandler
+
+        db_timings, request_timings = Timings(), Timings()
+        instrument_db(server, db_timings)
+
+        port = free_port()
+        n_threads = args.threads or server.SERVER_THREADS
+        httpd = create_server(server.app, host='127.0.0.1', port=port, threads=n_threads)
+        threading.Thread(target=httpd.run, name='XLD Server', daemon=True).start()
+
+        stop = threading.Event()
+        handler = XLDTempHandler(database=fridge.db, ip=None, update_interval=0.5, snapshot=fridge.snapshot,
+                                 controller=SimulatedController(db=fridge.db, latency=args.controller_latency))
+        controller = threading.Thread(target=handler.exec, args=(stop,), name='Temperature Controller', daemon=True)
+        controller.start()
+
+        events = {'go': defaultdict(list), 'done': defaultdict(list)}
+        client_kwargs = {'server_ip': '127.0.0.1', 'server_port': port, 'group': 'load-test',
+                         'update_interval': args.update_interval, 'long_poll': not args.no_long_poll}
+        if args.group_size > 1:
+            clients = [XLDMeasClientGroup(user=f'load-{k}', count=args.group_size, **client_kwargs)
+                       for k in range(args.clients)]
+        else:
+            clients = [XLDMeasClient(user=f'load-{k}', **client_kwargs) for k in range(args.clients)]
+        threads = [threading.Thread(target=run_client, args=(c, request_timings, events, args.meas_time), daemon=True)
+                   for c in clients]
+        for t in threads:
+            t.start()
+
+        while len(fridge.db.get_html_meas_dict()) < args.clients * args.group_size:
+            sleep(0.1)
+
+        admin = requests.Session()
+        base = f'http://127.0.0.1:{port}'
+        admin.post(base + '/login', data={'username': 'admin', 'password': 'load-test'})
+        admin.post(base + '/temperature-sweep/generate',
+                   json={'sweep_mode': 'direct-power', 'interpolation': 'linear', 'client_timeout': 10,
+                         'ret_base': False, 'skip_first': True, 'therm_time': 0,
+                         'min_pow': 0, 'max_pow': args.points - 1, 'n_pow': args.points})
+        admin.post(base + '/temperature-sweep/broadcast-start', json={'broadcast': True, 'start': False})
+        sweep_start = perf_counter()
+        admin.post(base + '/temperature-sweep/broadcast-start', json={'broadcast': False, 'start': True})
+
+        for t in threads:
+            t.join()
+        sweep_time = perf_counter() - sweep_start
+        stop.set()
+        controller.join()
+        fridge.snapshot.close()
+        fridge.snapshot.unlink()
+
+        request_timings.report('Client request latency')
+        db_timings.report('Database calls and lock waits in the server process')
+
+        overhead = [min(events['go'][i + 1]) - max(events['done'][i]) for i in range(args.points - 1)]
+        spread = [max(events['go'][i]) - min(events['go'][i]) for i in range(args.points)]
+        print(f"\nSweep of {args.points} points with {args.clients} clients of {args.group_size} measurements took "
+              f"{sweep_time:.2f} s ({args.points * args.meas_time:.2f} s of simulated measurement).")
+        print(f"Client requests: {sum(len(v) for v in request_timings.samples.values())}, database calls in the "
+              f"server process: {sum(len(v) for v in db_timings.samples.values())}")
+        print(f"Coordination overhead per point (last client done -> next GO): "
+              f"mean {np.mean(overhead) * 1e3:.1f} ms, max {np.max(overhead) * 1e3:.1f} ms")
+        print(f"GO delivery spread across clients: mean {np.mean(spread) * 1e3:.1f} ms, "
+              f"max {np.max(spread) * 1e3:.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
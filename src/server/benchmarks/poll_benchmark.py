@@ -0,0 +1,74 @@
+# Benchmark of the XLDTempHandler polling loop against the simulated controller.
+# Reports cycle times and the achieved sample rate for a given controller response latency, and the time
+# from a heater write in the database until the power reaches the controller.
+#   python benchmarks/poll_benchmark.py --latency 0.1 --interval 1 --duration 30
+import argparse
+import os
+import sys
+import tempfile
+from threading import Event, Thread, Timer
+from time import perf_counter, sleep
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'XLDServer'))
+
+from controllers import SimulatedController
+from database_sqlite import ServerDB
+from tempcomm import XLDTempHandler
+
+
+class TimedHandler(XLDTempHandler):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cycle_times = []
+
+    def cycle(self):
+        cycle_time = super().cycle()
+        self.cycle_times.append(cycle_time)
+        return cycle_time
+
+
+def send_commands(db: ServerDB, controller: SimulatedController, stop: Event, period: float, latencies: list):
+    k = 0
+    while not stop.wait(period):
+        k += 1
+        start = perf_counter()
+        db.write_heater(index=db.mxc_ind, val=float(k))
+        while controller.powers[db.mxc_ind] != float(k) and not stop.is_set():
+            sleep(0.001)
+        latencies.append(perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--latency', type=float, default=0.1, help='controller response latency per call (s)')
+    parser.add_argument('--interval', type=float, default=1, help='target update interval (s)')
+    parser.add_argument('--duration', type=float, default=20, help='benchmark duration (s)')
+    parser.add_argument('--command-period', type=float, default=0.77, help='time between heater commands (s)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = ServerDB(db_name=os.path.join(tmp, 'bench.db'))
+        db.prep_tables()
+        controller = SimulatedController(db=db, latency=args.latency)
+        handler = TimedHandler(database=db, ip=None, update_interval=args.interval, controller=controller)
+
+        stop = Event()
+        latencies = []
+        Timer(args.duration, stop.set).start()
+        Thread(target=send_commands, args=(db, controller, stop, args.command_period, latencies), daemon=True).start()
+        handler.exec(stop=stop)
+        db.close()
+
+    cycle_times = np.array(handler.cycle_times) * 1e3
+    n_calls = len(handler.temp_channels) + len(handler.heater_indices)
+    print(f"{len(cycle_times)} cycles, {n_calls} controller reads per cycle at {args.latency * 1e3:.0f} ms latency "
+          f"({n_calls * args.latency * 1e3:.0f} ms if issued serially).")
+    print(f"cycle time: p50 {np.percentile(cycle_times, 50):.1f} ms, p99 {np.percentile(cycle_times, 99):.1f} ms, "
+          f"max {cycle_times.max():.1f} ms")
+    print(f"achieved sample rate: {handler.achieved_rate:.3f} Hz (target {1 / args.interval:.3f} Hz)")
+
+    latencies = np.array(latencies) * 1e3
+    print(f"heater command latency ({len(latencies)} commands): p50 {np.percentile(latencies, 50):.1f} ms, "
+          f"p99 {np.percentile(latencies, 99):.1f} ms, max {latencies.max():.1f} ms")
@@ -0,0 +1,119 @@
+# Replays a whole temperature sweep against the simulated controller on a virtual clock.
+# The sweep, the temperature handler and the measurement clients all run in one thread on simulated time,
+# so hours of thermalization take seconds and the result is deterministic for a given seed.
+# Run from src/server with a passkey.py available on the path, e.g.:
+#   python benchmarks/virtual_sweep.py --points 20 --therm-time 1800 --clients 10
+import argparse
+import hashlib
+import os
+import sys
+import tempfile
+from multiprocessing import Event
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'XLDServer'))
+
+from clock import VirtualClock
+from controllers import SimulatedController
+from database_sqlite import ServerDB
+from measurements import GO
+from tempcomm import XLDTempHandler
+from temperature_sweep import TemperatureSweep
+
+
+class VirtualClient:
+    # Polls its signal like XLDMeasClient.listen, measures for meas_time after a GO and reports back.
+    def __init__(self, db: ServerDB, clock: VirtualClock, user: str, update_interval: float, meas_time: float,
+                 stuck: bool = False):
+        self.db = db
+        self.clock = clock
+        self.update_interval = update_interval
+        self.meas_time = meas_time
+        self.stuck = stuck
+        self.id = db.register_measurement(user=user, group='virtual')
+        self.points = []
+        clock.call_later(update_interval, self.poll)
+
+    def poll(self):
+        signal = self.db.get_meas_signal(self.id)
+        if signal == GO:
+            self.db.set_meas_status(meas_id=self.id, status=True, skip_crashed=True, timestamp=self.clock.now())
+            self.points.append((self.clock.time(), self.db.read_temp(channel=self.db.mxc_ch)))
+            if not self.stuck:
+                self.clock.call_later(self.meas_time, self.stopped)
+            return
+
+        self.clock.call_later(self.update_interval, self.poll)
+
+    def stopped(self):
+        self.db.set_meas_status(meas_id=self.id, status=False, skip_crashed=True, timestamp=self.clock.now())
+        self.clock.call_later(self.update_interval, self.poll)
+
+
+def run(args, tmp: str):
+    clock = VirtualClock(start=0)
+    db = ServerDB(db_name=os.path.join(tmp, f'virtual_{args.seed}.db'))
+    db.prep_tables()
+
+    controller = SimulatedController(db=db, latency=0, seed=args.seed, clock=clock)
+    handler = XLDTempHandler(database=db, ip=None, update_interval=args.update_interval, controller=controller,
+                             clock=clock)
+    clock.call_every(args.update_interval, handler.cycle)
+
+    clients = [VirtualClient(db, clock, f'virtual-{k}', args.client_interval, args.meas_time,
+                             stuck=k < args.stuck_clients) for k in range(args.clients)]
+
+    powers = [args.max_pow * k / (args.points - 1) for k in range(args.points)]
+    # PID mode targets the temperatures the direct-power sweep would settle at
+    setpoints = [controller.equilibrium_temp(db.mxc_ch, p) for p in powers] if args.pid else None
+    sweep = TemperatureSweep(thermalization_time=args.therm_time, power_array=powers,
+                             client_timeout=args.client_timeout, abort_flag=Event(), is_running=Event(),
+                             database=db, clock=clock, settle_tolerance=args.settle_tolerance,
+                             min_thermalization_time=args.min_therm_time, setpoints=setpoints,
+                             pid_gains=args.pid_gains, max_power=2 * args.max_pow)
+    if args.learned_map:
+        for p in powers[::4]:
+            db.write_power_map(power=p, temp=controller.equilibrium_temp(db.mxc_ch, p))
+
+    sweep.exec()
+    handler.pool.shutdown()
+    db.close()
+
+    return clock.time(), powers, clients
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--points', type=int, default=20, help='number of sweep points')
+    parser.add_argument('--max-pow', type=float, default=400, help='highest mixing chamber heater power (uW)')
+    parser.add_argument('--therm-time', type=float, default=1800, help='thermalization time per point (s)')
+    parser.add_argument('--clients', type=int, default=10, help='number of simulated measurement clients')
+    parser.add_argument('--stuck-clients', type=int, default=0, help='clients that never report back')
+    parser.add_argument('--settle-tolerance', type=float, default=None,
+                        help='end thermalization once settled within this relative tolerance, e.g. 0.01')
+    parser.add_argument('--min-therm-time', type=float, default=0, help='minimum adaptive thermalization (s)')
+    parser.add_argument('--pid', action='store_true', help='sweep temperature setpoints through the PID loop')
+    parser.add_argument('--pid-gains', type=float, nargs=3, default=(50, 0.2, 0), metavar=('P', 'I', 'D'),
+                        help='PID gains in uW/mK, uW/(mK s) and uW s/mK')
+    parser.add_argument('--learned-map', action='store_true',
+                        help='start with a power map as learned by an earlier sweep, for the feed-forward')
+    parser.add_argument('--meas-time', type=float, default=120, help='measurement duration per point (s)')
+    parser.add_argument('--client-timeout', type=float, default=600, help='sweep client timeout (s)')
+    parser.add_argument('--client-interval', type=float, default=5, help='client polling interval (s)')
+    parser.add_argument('--update-interval', type=float, default=10, help='temperature update interval (s)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        start = perf_counter()
+        virtual_time, powers, clients = run(args, tmp)
+        wall_time = perf_counter() - start
+
+    print(f"{'point':>6}{'power (uW)':>12}{'GO at (s)':>12}{'T_mxc (mK)':>12}")
+    for i, power in enumerate(powers):
+        go_time, temp = clients[-1].points[i]
+        print(f"{i + 1:>6}{power:>12.1f}{go_time:>12.0f}{temp * 1e3:>12.3f}")
+
+    digest = hashlib.sha256(repr([c.points for c in clients]).encode()).hexdigest()[:16]
+    print(f"\nReplayed {virtual_time / 3600:.2f} h of sweep in {wall_time:.2f} s "
+          f"({virtual_time / wall_time:.0f}x real time). Result digest: {digest}")